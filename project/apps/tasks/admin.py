@@ -1,6 +1,34 @@
 from django.contrib import admin
 from apps.tasks.models import Task, Comment, TaskDuration
 
-admin.site.register(Task)
-admin.site.register(TaskDuration)
-admin.site.register(Comment)
+
+class LargeTableAdmin(admin.ModelAdmin):
+    show_full_result_count = False
+    date_hierarchy = 'created_at'
+    ordering = ('-id',)
+    sortable_by = ('id',)
+    list_per_page = 50
+
+
+@admin.register(Task)
+class TaskAdmin(LargeTableAdmin):
+    list_display = ('id', 'title', 'status', 'owner', 'created_at')
+    list_select_related = ('owner',)
+    list_filter = ('status',)
+    raw_id_fields = ('owner', 'parent')
+
+
+@admin.register(TaskDuration)
+class TaskDurationAdmin(LargeTableAdmin):
+    list_display = ('id', 'task_id', 'owner', 'start_working_datetime', 'duration', 'timer_on')
+    list_select_related = ('owner',)
+    list_filter = ('timer_on',)
+    raw_id_fields = ('task', 'owner')
+    date_hierarchy = 'start_working_datetime'
+
+
+@admin.register(Comment)
+class CommentAdmin(LargeTableAdmin):
+    list_display = ('id', 'task_id', 'author', 'created_at')
+    list_select_related = ('author',)
+    raw_id_fields = ('task', 'author')
@@ -0,0 +1,53 @@
+from datetime import datetime, timezone
+
+import django_filters
+from django.db.models import Exists, IntegerField, OuterRef, Q, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+from .models import Task, TaskDuration
+
+
+class TaskFilter(django_filters.FilterSet):
+    """
+    Filters of the task listing. Each one is backed by an index on Task or TaskDuration.
+    """
+    status = django_filters.MultipleChoiceFilter(choices=Task.TASK_STATUS_CHOICES)
+    owner = django_filters.NumberFilter(field_name='owner')
+    created = django_filters.IsoDateTimeFromToRangeFilter(field_name='created_at')
+    updated = django_filters.IsoDateTimeFromToRangeFilter(field_name='updated_at')
+    has_running_timer = django_filters.BooleanFilter(method='filter_has_running_timer')
+    min_logged_time = django_filters.NumberFilter(
+        method='filter_min_logged_time', min_value=0, label='Minimum logged time in minutes'
+    )
+    overdue = django_filters.BooleanFilter(method='filter_overdue')
+
+    class Meta:
+        model = Task
+        fields = ('status', 'owner', 'created', 'updated', 'has_running_timer', 'min_logged_time', 'overdue')
+
+    def filter_has_running_timer(self, queryset, name, value):
+        # Backed by the running_timer_task_idx partial index
+        running_timers = TaskDuration.all_objects.filter(task=OuterRef('pk'), timer_on=True)
+        if value:
+            return queryset.filter(Exists(running_timers))
+        return queryset.exclude(Exists(running_timers))
+
+    def filter_min_logged_time(self, queryset, name, value):
+        # Backed by the covering task_logged_duration_idx index
+        logged_time = TaskDuration.all_objects \
+            .filter(task=OuterRef('pk')) \
+            .order_by() \
+            .values('task') \
+            .annotate(total=Sum('duration')) \
+            .values('total')
+        return queryset \
+            .annotate(logged_time=Coalesce(Subquery(logged_time, output_field=IntegerField()), 0)) \
+            .filter(logged_time__gte=value * 60)
+
+    def filter_overdue(self, queryset, name, value):
+        # Backed by the open_task_due_idx partial index
+        overdue = Q(due_at__lt=datetime.now(timezone.utc)) & ~Q(status='CO')
+        if value:
+            return queryset.filter(overdue)
+        # Tasks without a due date, due later or complete
+        return queryset.exclude(overdue)
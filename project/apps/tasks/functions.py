@@ -0,0 +1,22 @@
+from django.db.models import Func, IntegerField
+
+
+class SecondsBetween(Func):
+    """
+    Whole seconds elapsed between two datetime expressions, computed by the database.
+    """
+    arity = 2
+    output_field = IntegerField()
+    template = 'CAST(EXTRACT(EPOCH FROM (%(expressions)s)) AS INTEGER)'
+    arg_joiner = ' - '
+
+    def __init__(self, start, end, **extra):
+        super().__init__(end, start, **extra)
+
+    def as_sqlite(self, compiler, connection, **extra_context):
+        return self.as_sql(
+            compiler, connection,
+            template='CAST(ROUND((julianday(%(expressions)s)) * 86400) AS INTEGER)',
+            arg_joiner=') - julianday(',
+            **extra_context
+        )
@@ -0,0 +1,109 @@
+"""
+Bulk import of time logs from CSV or NDJSON.
+
+Rows are read lazily and handled `chunk_size` at a time: each chunk is
+validated, its task ids resolved with one query per shard and its valid rows
+inserted with `bulk_create`, so memory stays bounded by the chunk size.
+Chunks are committed independently; invalid rows, and the rows of a chunk the
+database rejects, are reported, not fatal.
+"""
+import csv
+import json
+from collections import defaultdict
+from itertools import islice
+from typing import Iterable, Iterator, Optional
+
+from django.conf import settings
+from django.db import DatabaseError, transaction
+from rest_framework import serializers
+from rest_framework.settings import api_settings
+
+from apps.users.models import CustomUser
+from .models import TaskDuration
+from .serializers import ImportTimeLogSerializer
+from .sharding import assign_shard_ids, shards_for_tasks
+
+INSERT_ERROR = 'The database rejected this chunk of rows.'
+
+IMPORT_FORMATS = {
+    '.csv': 'csv',
+    '.ndjson': 'ndjson',
+    '.jsonl': 'ndjson',
+}
+
+
+def get_import_format(file_name: str) -> Optional[str]:
+    for extension, import_format in IMPORT_FORMATS.items():
+        if file_name.lower().endswith(extension):
+            return import_format
+    return None
+
+
+def parse_json_line(line: str):
+    try:
+        return json.loads(line)
+    except ValueError:
+        # Reported by the serializer as a row that is not an object
+        return line
+
+
+def read_records(lines: Iterable[str], import_format: str) -> Iterator:
+    if import_format == 'csv':
+        return csv.DictReader(lines)
+    return (parse_json_line(line) for line in lines if line.strip())
+
+
+def import_time_logs(records: Iterable, owner: CustomUser, chunk_size: int = None) -> dict:
+    """
+    Insert a time log for every valid record, `duration` being in minutes as for
+    `AddTimeOnSpecificDateSerializer`. Returns the number of imported and failed
+    rows and the errors of the first `IMPORT_MAX_ERRORS` failed rows.
+    """
+    chunk_size = chunk_size or settings.IMPORT_CHUNK_SIZE
+    serializer = ImportTimeLogSerializer()
+    numbered_records = enumerate(records, start=1)
+    report = {'imported': 0, 'failed': 0, 'errors': []}
+
+    while True:
+        chunk = list(islice(numbered_records, chunk_size))
+        if not chunk:
+            return report
+
+        valid_rows, failed_rows = [], []
+        for row, record in chunk:
+            try:
+                valid_rows.append((row, serializer.run_validation(record)))
+            except serializers.ValidationError as exc:
+                failed_rows.append((row, serializers.as_serializer_error(exc)))
+
+        task_shards = shards_for_tasks({data['task'] for _, data in valid_rows})
+        time_logs = defaultdict(list)
+        for row, data in valid_rows:
+            shard = task_shards.get(data['task'])
+            if shard is None:
+                failed_rows.append((row, {'task': ['Task does not exist.']}))
+                continue
+            time_logs[shard].append((row, TaskDuration(
+                owner=owner,
+                task_id=data['task'],
+                start_working_datetime=data['start_working_datetime'],
+                duration=data['duration'] * 60,
+                timer_on=False,
+            )))
+
+        for shard, shard_rows in time_logs.items():
+            shard_time_logs = [time_log for _, time_log in shard_rows]
+            try:
+                with transaction.atomic(using=shard):
+                    assign_shard_ids(shard_time_logs, shard)
+                    TaskDuration.objects.using(shard).bulk_create(shard_time_logs, batch_size=chunk_size)
+            except DatabaseError:
+                # Earlier chunks stay imported, the rows of this one are reported like invalid rows
+                failed_rows.extend((row, {api_settings.NON_FIELD_ERRORS_KEY: [INSERT_ERROR]}) for row, _ in shard_rows)
+                continue
+            report['imported'] += len(shard_time_logs)
+
+        report['failed'] += len(failed_rows)
+        for row, errors in sorted(failed_rows, key=lambda failed_row: failed_row[0]):
+            if len(report['errors']) < settings.IMPORT_MAX_ERRORS:
+                report['errors'].append({'row': row, 'errors': errors})
@@ -0,0 +1,56 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db.models import Case, DateTimeField, Value, When
+
+from apps.tasks.models import TaskDuration
+from apps.tasks.service import get_timer_heartbeats
+from apps.tasks.sharding import get_shards
+
+
+class Command(BaseCommand):
+    help = 'Persist the timer heartbeats kept in the cache to the last_heartbeat_at of running timers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Timers updated per UPDATE statement')
+        parser.add_argument('--interval', type=int, help='Keep running, flushing every INTERVAL seconds')
+
+    def flush(self, shard: str, batch_size: int) -> int:
+        running_timers = TaskDuration.all_objects \
+            .using(shard) \
+            .filter(timer_on=True) \
+            .order_by('pk') \
+            .values_list('pk', 'owner_id', 'task_id', 'start_working_datetime', 'last_heartbeat_at')
+
+        flushed = 0
+        last_id = 0
+        while True:
+            batch = list(running_timers.filter(pk__gt=last_id)[:batch_size])
+            if not batch:
+                return flushed
+            last_id = batch[-1][0]
+
+            heartbeats = get_timer_heartbeats([(pk, owner_id, task_id) for pk, owner_id, task_id, _, _ in batch])
+            # Skip heartbeats already flushed and heartbeats left over from before the timer was restarted
+            heartbeats = {
+                pk: heartbeats[pk]
+                for pk, _, _, start_working_datetime, last_heartbeat_at in batch
+                if pk in heartbeats and heartbeats[pk] > start_working_datetime
+                and (last_heartbeat_at is None or heartbeats[pk] > last_heartbeat_at)
+            }
+            if heartbeats:
+                flushed += TaskDuration.all_objects.using(shard).filter(pk__in=heartbeats, timer_on=True).update(
+                    last_heartbeat_at=Case(
+                        *(When(pk=pk, then=Value(heartbeat)) for pk, heartbeat in heartbeats.items()),
+                        output_field=DateTimeField(),
+                    )
+                )
+
+    def handle(self, *args, **options):
+        while True:
+            flushed = sum(self.flush(shard, options['batch_size']) for shard in get_shards())
+            self.stdout.write(self.style.SUCCESS(f'Flushed heartbeats of {flushed} running timers'))
+
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,36 @@
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.tasks.imports import get_import_format, import_time_logs, read_records
+from apps.users.models import CustomUser
+
+
+class Command(BaseCommand):
+    help = 'Import time logs from a CSV or NDJSON file with task, start_working_datetime and duration in minutes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='.csv, .ndjson or .jsonl file')
+        parser.add_argument('--owner', required=True, help='Email of the user the time logs are logged by')
+        parser.add_argument(
+            '--batch-size', type=int, default=settings.IMPORT_CHUNK_SIZE,
+            help='Rows validated and inserted at a time'
+        )
+
+    def handle(self, *args, **options):
+        import_format = get_import_format(options['path'])
+        if import_format is None:
+            raise CommandError('The file must be a .csv, .ndjson or .jsonl file')
+        owner = CustomUser.objects.filter(email=options['owner']).first()
+        if owner is None:
+            raise CommandError(f'There is no user with email {options["owner"]}')
+
+        with open(options['path'], newline='', encoding='utf-8', errors='replace') as lines:
+            report = import_time_logs(read_records(lines, import_format), owner, options['batch_size'])
+
+        for error in report['errors']:
+            self.stderr.write(f'Row {error["row"]}: {json.dumps(error["errors"])}')
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {report["imported"]} time logs, {report["failed"]} rows failed'
+        ))
@@ -1,10 +1,12 @@
 from datetime import datetime, timezone
 import random
 
+from django.core.management import call_command
 from django.core.management.base import BaseCommand, CommandError
 import lorem
 
 from apps.tasks.models import Task, TaskDuration
+from apps.tasks.sharding import assign_shard_ids, shard_for_owner
 from apps.users.models import CustomUser
 
 
@@ -19,10 +21,11 @@ class Command(BaseCommand):
             description=lorem.paragraph()
         ) for _ in range(25000)]
 
-        Task.objects.bulk_create(task_list)
+        assign_shard_ids(task_list, self.shard)
+        Task.objects.using(self.shard).bulk_create(task_list)
 
     def insert_task_duration(self):
-        task_id_list = tuple(Task.objects.all().values_list('id', flat=True))
+        task_id_list = tuple(Task.objects.using(self.shard).values_list('id', flat=True))
 
         task_time_list = [TaskDuration(
             owner=self.user,
@@ -31,13 +34,17 @@ class Command(BaseCommand):
             duration=random.randint(60, 24000)
         ) for _ in range(50000)]
 
-        TaskDuration.objects.bulk_create(task_time_list)
+        assign_shard_ids(task_time_list, self.shard)
+        TaskDuration.objects.using(self.shard).bulk_create(task_time_list)
 
     def handle(self, *args, **options):
         self.user = CustomUser.objects.first()
         if not self.user:
             raise CommandError('There must exist at least one user')
+        self.shard = shard_for_owner(self.user.pk)
 
         self.insert_tasks()
         self.insert_task_duration()
+        call_command('reconciletaskcounters', stdout=self.stdout)
+        call_command('rebuildtaskclosure', stdout=self.stdout)
         self.stdout.write(self.style.SUCCESS('Successfully'))
\ No newline at end of file
@@ -0,0 +1,107 @@
+from datetime import datetime, timezone
+import time
+from collections import Counter
+from typing import Optional
+
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import BigIntegerField, Q, Value
+
+from apps.tasks.models import Task, TaskClosure, TaskShard, TaskStatusCounter, Comment, TaskDuration, Tombstone
+from apps.tasks.sharding import get_shards, is_sharded
+
+
+class Command(BaseCommand):
+    help = (
+        'Mark the tasks below deleted tasks deleted, then remove tasks marked deleted '
+        'together with their comments and time logs, in bounded batches'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Rows removed per DELETE statement')
+        parser.add_argument('--interval', type=int, help='Keep running, purging every INTERVAL seconds')
+
+    def purge_dependants(
+        self, model, using: str, task_id: int, batch_size: int, owner_field: Optional[str] = None
+    ) -> int:
+        purged = 0
+
+        while True:
+            with transaction.atomic(using=using):
+                rows = list(
+                    model.all_objects.using(using)
+                    .filter(task_id=task_id)
+                    .values_list('pk', owner_field or Value(None, output_field=BigIntegerField()))[:batch_size]
+                )
+                if not rows:
+                    return purged
+
+                Tombstone.objects.using(using).bulk_create([
+                    Tombstone(model_name=model._meta.model_name, object_id=object_id, owner_id=owner_id)
+                    for object_id, owner_id in rows
+                ])
+                ids = [object_id for object_id, _ in rows]
+                # Signals and cascades are bypassed on purpose: tombstones are written above
+                # and the task has already been uncounted by Task.mark_deleted.
+                purged += model.all_objects.using(using).filter(pk__in=ids)._raw_delete(using)
+
+    def mark_descendants(self, using: str, batch_size: int) -> int:
+        # Hidden since an ancestor was marked deleted, but still counted
+        hidden_tasks = Task.all_objects.using(using).filter(
+            deleted_at__isnull=True, ancestor_links__ancestor__deleted_at__isnull=False
+        )
+
+        marked = 0
+        while True:
+            with transaction.atomic(using=using):
+                task_ids = list(hidden_tasks.values_list('pk', flat=True).distinct()[:batch_size])
+                tasks = list(
+                    Task.all_objects.using(using)
+                    .select_for_update()
+                    .filter(pk__in=task_ids, deleted_at__isnull=True)
+                    .values_list('pk', 'owner_id', 'status')
+                )
+                now = datetime.now(timezone.utc)
+                Task.all_objects.using(using).filter(pk__in=[pk for pk, _, _ in tasks]).update(
+                    deleted_at=now, updated_at=now
+                )
+                for (owner_id, status), count in Counter((owner_id, status) for _, owner_id, status in tasks).items():
+                    TaskStatusCounter.objects.using(using).adjust(owner_id, status, -count)
+                Tombstone.objects.using(using).bulk_create([
+                    Tombstone(model_name=Task._meta.model_name, object_id=pk) for pk, _, _ in tasks
+                ])
+
+            marked += len(tasks)
+            if len(task_ids) < batch_size:
+                return marked
+
+    def purge(self, using: str, batch_size: int) -> int:
+        self.mark_descendants(using, batch_size)
+        deleted_tasks = Task.all_objects.using(using).filter(deleted_at__isnull=False).order_by('deleted_at')
+
+        purged = 0
+        while True:
+            task_ids = list(deleted_tasks.values_list('pk', flat=True)[:batch_size])
+            for task_id in task_ids:
+                self.purge_dependants(Comment, using, task_id, batch_size)
+                self.purge_dependants(TaskDuration, using, task_id, batch_size, owner_field='owner_id')
+            # Every task below a deleted one is marked by now, children left for a later batch go with them
+            TaskClosure.objects.using(using).filter(
+                Q(ancestor_id__in=task_ids) | Q(descendant_id__in=task_ids)
+            )._raw_delete(using)
+            Task.all_objects.using(using).filter(parent_id__in=task_ids).update(parent=None)
+            purged += Task.all_objects.using(using).filter(pk__in=task_ids)._raw_delete(using)
+            if is_sharded():
+                TaskShard.objects.filter(task_id__in=task_ids)._raw_delete(DEFAULT_DB_ALIAS)
+
+            if len(task_ids) < batch_size:
+                return purged
+
+    def handle(self, *args, **options):
+        while True:
+            purged = sum(self.purge(shard, options['batch_size']) for shard in get_shards())
+            self.stdout.write(self.style.SUCCESS(f'Purged {purged} deleted tasks'))
+
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
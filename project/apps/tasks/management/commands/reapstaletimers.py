@@ -0,0 +1,71 @@
+from datetime import datetime, timezone, timedelta
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models.functions import Coalesce, Now
+
+from apps.tasks.functions import SecondsBetween
+from apps.tasks.models import TaskDuration
+from apps.tasks.service import mark_timers_stopped
+from apps.tasks.sharding import get_shards
+
+
+class Command(BaseCommand):
+    help = 'Stop running timers idle for longer than TIMER_IDLE_LIMIT, crediting them up to their last ' \
+           'heartbeat or, without heartbeats, with no time'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--idle-minutes', type=int,
+            default=int(settings.TIMER_IDLE_LIMIT.total_seconds() // 60),
+            help='Stop timers without a heartbeat or start for this many minutes',
+        )
+        parser.add_argument('--batch-size', type=int, default=1000, help='Timers stopped per UPDATE statement')
+        parser.add_argument('--interval', type=int, help='Keep running, reaping every INTERVAL seconds')
+
+    def reap(self, shard: str, idle_limit: timedelta, batch_size: int) -> int:
+        cutoff = datetime.now(timezone.utc) - idle_limit
+        # The last time the timer is known to have been in use, nothing after it is credited
+        last_seen_at = Coalesce('last_heartbeat_at', 'start_working_datetime')
+        stale_timers = TaskDuration.objects \
+            .using(shard) \
+            .annotate(last_seen_at=last_seen_at) \
+            .filter(timer_on=True, start_working_datetime__lt=cutoff, last_seen_at__lt=cutoff) \
+            .order_by('start_working_datetime')
+
+        reaped = 0
+        while True:
+            with transaction.atomic(using=shard):
+                batch = list(
+                    stale_timers.select_for_update(skip_locked=True, of=('self',))
+                    .values_list('pk', 'owner_id', 'task_id')[:batch_size]
+                )
+                TaskDuration.objects \
+                    .using(shard) \
+                    .filter(pk__in=[pk for pk, _, _ in batch]) \
+                    .update(
+                        timer_on=False,
+                        auto_stopped=True,
+                        stop_working_datetime=last_seen_at,
+                        duration=Coalesce('duration', 0) + SecondsBetween('start_working_datetime', last_seen_at),
+                        updated_at=Now(),
+                    )
+            # Answered by the heartbeat endpoint, so clients learn their timer is gone
+            mark_timers_stopped([(owner_id, task_id) for _, owner_id, task_id in batch])
+
+            reaped += len(batch)
+            if len(batch) < batch_size:
+                return reaped
+
+    def handle(self, *args, **options):
+        idle_limit = timedelta(minutes=options['idle_minutes'])
+
+        while True:
+            reaped = sum(self.reap(shard, idle_limit, options['batch_size']) for shard in get_shards())
+            self.stdout.write(self.style.SUCCESS(f'Stopped {reaped} stale timers'))
+
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,95 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models.functions import Mod
+
+from apps.tasks.models import Task, TaskClosure, Comment, TaskDuration, TaskShard, TaskStatusCounter
+from apps.tasks.sharding import allocate_ids, copy_user_to_shards, get_shards, is_sharded, shard_for_owner
+from apps.users.models import CustomUser
+
+
+class Command(BaseCommand):
+    help = 'Move tasks to the shard of their owner after owner changes or TASK_SHARDS changes. ' \
+           'Tasks in a hierarchy stay on the shard of their tree.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Rows copied per INSERT statement')
+        parser.add_argument(
+            '--backfill', action='store_true',
+            help='First copy every user to every shard and register every task, '
+                 'needed once when enabling sharding or adding a shard'
+        )
+
+    def backfill(self, batch_size: int):
+        """
+        Copy users to every shard, register every task in the shard directory
+        and start the shared id sequence past the ids already in use.
+        """
+        for user in CustomUser.objects.using(DEFAULT_DB_ALIAS).iterator():
+            copy_user_to_shards(user)
+
+        for shard in get_shards():
+            task_ids = Task.all_objects.using(shard).order_by('pk').values_list('pk', flat=True)
+            last_id = 0
+            while True:
+                batch = list(task_ids.filter(pk__gt=last_id)[:batch_size])
+                if not batch:
+                    break
+                TaskShard.objects.bulk_create(
+                    [TaskShard(task_id=task_id, shard=shard) for task_id in batch],
+                    ignore_conflicts=True
+                )
+                last_id = batch[-1]
+
+        allocate_ids(0)
+
+    def move_rows(self, model, task: Task, source: str, target: str, batch_size: int):
+        rows = model.all_objects.using(source).filter(task_id=task.pk).order_by('pk')
+        while True:
+            batch = list(rows[:batch_size])
+            if not batch:
+                return
+            model.all_objects.using(target).bulk_create(batch, ignore_conflicts=True)
+            model.all_objects.using(source).filter(pk__in=[row.pk for row in batch])._raw_delete(source)
+
+    def move_task(self, task: Task, source: str, target: str, batch_size: int):
+        with transaction.atomic(using=source), transaction.atomic(using=target):
+            Task.all_objects.using(target).bulk_create([task], ignore_conflicts=True)
+            self.move_rows(Comment, task, source, target, batch_size)
+            self.move_rows(TaskDuration, task, source, target, batch_size)
+            TaskClosure.objects.using(source).filter(descendant_id=task.pk)._raw_delete(source)
+            TaskClosure.objects.using(target).create(ancestor_id=task.pk, descendant_id=task.pk, depth=0)
+            Task.all_objects.using(source).filter(pk=task.pk)._raw_delete(source)
+
+            if task.deleted_at is None:
+                TaskStatusCounter.objects.using(source).adjust(task.owner_id, task.status, -1)
+                TaskStatusCounter.objects.using(target).adjust(task.owner_id, task.status, 1)
+
+        TaskShard.objects.update_or_create(task_id=task.pk, defaults={'shard': target})
+
+    def handle(self, *args, **options):
+        if not is_sharded():
+            raise CommandError('TASK_SHARDS lists a single database, there is nothing to rebalance')
+
+        batch_size = options['batch_size']
+        if options['backfill']:
+            self.backfill(batch_size)
+
+        shards = get_shards()
+        moved = 0
+        for shard_index, source in enumerate(shards):
+            misplaced_tasks = Task.all_objects \
+                .using(source) \
+                .annotate(shard_index=Mod('owner_id', len(shards))) \
+                .exclude(shard_index=shard_index) \
+                .filter(parent__isnull=True, children__isnull=True) \
+                .order_by('pk')
+
+            while True:
+                batch = list(misplaced_tasks[:batch_size])
+                if not batch:
+                    break
+                for task in batch:
+                    self.move_task(task, source, shard_for_owner(task.owner_id), batch_size)
+                moved += len(batch)
+
+        self.stdout.write(self.style.SUCCESS(f'Moved {moved} tasks'))
@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction
+
+from apps.tasks.models import Task, TaskClosure
+from apps.tasks.sharding import get_shards
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the task hierarchy closure table from Task.parent, one tree level per INSERT statement'
+
+    def rebuild(self, using: str) -> int:
+        connection = connections[using]
+        closure_table = connection.ops.quote_name(TaskClosure._meta.db_table)
+        task_table = connection.ops.quote_name(Task._meta.db_table)
+
+        with transaction.atomic(using=using), connection.cursor() as cursor:
+            TaskClosure.objects.using(using).all()._raw_delete(using)
+            cursor.execute(
+                f'INSERT INTO {closure_table} (ancestor_id, descendant_id, depth) '
+                f'SELECT id, id, 0 FROM {task_table}'
+            )
+            linked = cursor.rowcount
+
+            depth = 0
+            while True:
+                # Links at depth + 1 are the links at depth extended by one child
+                cursor.execute(
+                    f'INSERT INTO {closure_table} (ancestor_id, descendant_id, depth) '
+                    f'SELECT closure.ancestor_id, task.id, closure.depth + 1 '
+                    f'FROM {task_table} task JOIN {closure_table} closure ON closure.descendant_id = task.parent_id '
+                    f'WHERE closure.depth = %s',
+                    [depth]
+                )
+                if not cursor.rowcount:
+                    return linked
+                linked += cursor.rowcount
+                depth += 1
+
+    def handle(self, *args, **options):
+        linked = sum(self.rebuild(shard) for shard in get_shards())
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {linked} task closure links'))
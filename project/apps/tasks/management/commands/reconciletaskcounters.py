@@ -0,0 +1,58 @@
+from typing import Tuple
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+
+from apps.tasks.models import Task, TaskStatusCounter
+from apps.tasks.sharding import get_shards
+
+
+class Command(BaseCommand):
+    help = 'Recount tasks per owner and status and repair drifted task status counters'
+
+    def reconcile(self, using: str) -> Tuple[int, int]:
+        with transaction.atomic(using=using):
+            counters = {
+                (counter.owner_id, counter.status): counter
+                for counter in TaskStatusCounter.objects.using(using).select_for_update()
+            }
+            actual_counts = {
+                (owner_id, status): count
+                # Tasks below a deleted one stay counted until purgedeletedtasks marks them
+                for owner_id, status, count in Task.all_objects
+                .using(using)
+                .filter(deleted_at__isnull=True)
+                .values('owner_id', 'status')
+                .annotate(count=Count('id'))
+                .values_list('owner_id', 'status', 'count')
+                .order_by()
+            }
+
+            missing_counters = [
+                TaskStatusCounter(owner_id=owner_id, status=status, count=count)
+                for (owner_id, status), count in actual_counts.items()
+                if (owner_id, status) not in counters
+            ]
+            drifted_counters = []
+            for key, counter in counters.items():
+                count = actual_counts.get(key, 0)
+                if counter.count != count:
+                    counter.count = count
+                    drifted_counters.append(counter)
+
+            TaskStatusCounter.objects.using(using).bulk_create(missing_counters)
+            TaskStatusCounter.objects.using(using).bulk_update(drifted_counters, ['count'])
+
+        return len(drifted_counters), len(missing_counters)
+
+    def handle(self, *args, **options):
+        drifted, missing = 0, 0
+        for shard in get_shards():
+            shard_drifted, shard_missing = self.reconcile(shard)
+            drifted += shard_drifted
+            missing += shard_missing
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Repaired {drifted} counters and created {missing} missing ones'
+        ))
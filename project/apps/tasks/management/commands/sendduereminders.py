@@ -0,0 +1,94 @@
+from collections import defaultdict
+from datetime import datetime, timezone, timedelta
+import time
+from typing import Optional
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from apps.tasks.models import Task
+from apps.tasks.service import send_user_email
+from apps.tasks.sharding import get_shards
+
+
+class Command(BaseCommand):
+    help = 'Remind owners of tasks due within TASK_DUE_REMINDER_LEAD, including windows missed while not running'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help='Tasks reminded per transaction')
+        parser.add_argument(
+            '--interval', type=int,
+            help='Keep running, sleeping until the next task is due but at most INTERVAL seconds'
+        )
+
+    def pending_reminders(self, shard: str):
+        # Matches the pending_due_reminder_idx partial index
+        return Task.objects \
+            .using(shard) \
+            .filter(due_at__isnull=False, due_reminder_sent_at__isnull=True) \
+            .exclude(status='CO') \
+            .order_by('due_at')
+
+    def remind(self, shard: str, batch_size: int) -> int:
+        window_end = datetime.now(timezone.utc) + settings.TASK_DUE_REMINDER_LEAD
+        due_tasks = self.pending_reminders(shard).filter(due_at__lte=window_end)
+
+        reminded = 0
+        failed_task_ids = []
+        while True:
+            # Claimed and committed before sending, so a failed send never rolls back reminders already sent
+            with transaction.atomic(using=shard):
+                batch = list(
+                    due_tasks.select_for_update(skip_locked=True, of=('self',))
+                    .values_list('pk', 'owner__email')[:batch_size]
+                )
+                Task.objects.using(shard).filter(pk__in=[pk for pk, _ in batch]).update(
+                    due_reminder_sent_at=datetime.now(timezone.utc)
+                )
+
+            task_ids_by_email = defaultdict(list)
+            for pk, email in batch:
+                task_ids_by_email[email].append(pk)
+            for email, task_ids in task_ids_by_email.items():
+                try:
+                    send_user_email(email, 'due')
+                except OSError as error:
+                    self.stderr.write(self.style.ERROR(f'Could not remind {email}: {error}'))
+                    failed_task_ids.extend(task_ids)
+                else:
+                    reminded += len(task_ids)
+
+            if len(batch) < batch_size:
+                break
+
+        # Retried on the next run rather than in this loop, which would spin while the mail server is down
+        Task.objects.using(shard).filter(pk__in=failed_task_ids).update(due_reminder_sent_at=None)
+        return reminded
+
+    def next_due_at(self) -> Optional[datetime]:
+        # Tasks already in the window were reminded, or failed and are retried after the interval
+        window_end = datetime.now(timezone.utc) + settings.TASK_DUE_REMINDER_LEAD
+        due_dates = [
+            due_at
+            for shard in get_shards()
+            for due_at in self.pending_reminders(shard)
+            .filter(due_at__gt=window_end)
+            .values_list('due_at', flat=True)[:1]
+        ]
+        return min(due_dates, default=None)
+
+    def handle(self, *args, **options):
+        while True:
+            reminded = sum(self.remind(shard, options['batch_size']) for shard in get_shards())
+            self.stdout.write(self.style.SUCCESS(f'Sent reminders for {reminded} due tasks'))
+
+            if not options['interval']:
+                break
+
+            sleep = options['interval']
+            next_due_at = self.next_due_at()
+            if next_due_at is not None:
+                until_window = next_due_at - settings.TASK_DUE_REMINDER_LEAD - datetime.now(timezone.utc)
+                sleep = min(sleep, max(until_window, timedelta(seconds=1)).total_seconds())
+            time.sleep(sleep)
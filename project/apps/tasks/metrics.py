@@ -0,0 +1,55 @@
+from config.metrics import Counter, Histogram, MetricFamily, registry
+from .models import TaskDuration
+from .sharding import get_shards
+from .throttling import get_throttle_counters, uses_redis_cache
+
+REQUESTS = Counter(
+    'task_requests_total', 'Requests to the task API by action and response status', ('action', 'status')
+)
+REQUEST_DURATION = Histogram(
+    'task_request_duration_seconds', 'Time spent handling task API requests by action', ('action',)
+)
+EMAIL_SEND_DURATION = Histogram(
+    'email_send_duration_seconds', 'Time spent sending notification emails by message type', ('message_type',)
+)
+
+
+@registry.register_collector
+def collect_running_timers():
+    running = sum(TaskDuration.objects.using(shard).filter(timer_on=True).count() for shard in get_shards())
+    return [
+        MetricFamily('task_running_timers', 'gauge', 'Task timers currently running', [
+            ('task_running_timers', {}, running),
+        ]),
+    ]
+
+
+@registry.register_collector
+def collect_throttle_counters():
+    samples = [
+        ('task_throttle_requests_total', {'action': action, 'outcome': outcome}, count)
+        for action, counters in get_throttle_counters().items()
+        for outcome, count in counters.items()
+    ]
+    return [
+        MetricFamily(
+            'task_throttle_requests_total', 'counter',
+            'Requests seen by TokenBucketThrottle by action and outcome', samples
+        ),
+    ]
+
+
+@registry.register_collector
+def collect_redis_cache_lookups():
+    if not uses_redis_cache():
+        return []
+
+    from django_redis import get_redis_connection
+
+    stats = get_redis_connection('default').info('stats')
+    return [
+        MetricFamily('cache_backend_lookups_total', 'counter', 'Key lookups served by the Redis cache by outcome', [
+            ('cache_backend_lookups_total', {'outcome': 'hit'}, stats['keyspace_hits']),
+            ('cache_backend_lookups_total', {'outcome': 'miss'}, stats['keyspace_misses']),
+        ]),
+    ]
@@ -1,16 +1,79 @@
-from django.db import models
+from datetime import datetime, timezone
+from typing import Optional
+
+from django.db import connections, models, router, transaction
+from django.db.models import F, Q
+from django.db.models.functions import Greatest
+from django.utils import timezone as django_timezone
 
 from apps.users.models import CustomUser
+from .sharding import shard_for_owner, shard_for_task
 
 
 class TimeStampedModel(models.Model):
-    created_at = models.DateTimeField(auto_now_add=True)
-    updated_at = models.DateTimeField(auto_now=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
 
     class Meta:
         abstract = True
 
 
+def hidden_task_ids():
+    """
+    Ids of the tasks below tasks marked deleted, read from the few deleted
+    tasks the purgedeletedtasks command has not removed yet. The subquery does
+    not depend on the row filtered, so it is run once per query and costs the
+    same whatever the depth of the tree.
+    """
+    deleted_tasks = Task.all_objects.filter(deleted_at__isnull=False).values('pk')
+    return TaskClosure.objects.filter(ancestor_id__in=deleted_tasks).values('descendant_id')
+
+
+class ActiveTaskManager(models.Manager):
+    """
+    Hides tasks marked deleted, and the tasks below them, until the
+    purgedeletedtasks command removes them.
+    """
+    def get_queryset(self):
+        return super().get_queryset() \
+            .filter(deleted_at__isnull=True) \
+            .exclude(pk__in=hidden_task_ids())
+
+    def create(self, **kwargs):
+        # QuerySet.create would pin the row to the default database, let the router pick the shard
+        task = self.model(**kwargs)
+        task.save(force_insert=True)
+        return task
+
+    def for_owner(self, owner_id: int):
+        return self.using(shard_for_owner(owner_id))
+
+    def for_task(self, task_id: int):
+        shard = shard_for_task(task_id)
+        if shard is None:
+            return self.none()
+        return self.using(shard)
+
+
+class ActiveTaskRelatedManager(models.Manager):
+    """
+    Hides rows that belong to tasks marked deleted or below one.
+    """
+    def get_queryset(self):
+        return super().get_queryset() \
+            .filter(task__deleted_at__isnull=True) \
+            .exclude(task_id__in=hidden_task_ids())
+
+    def create(self, **kwargs):
+        # QuerySet.create would pin the row to the default database, let the router pick the task's shard
+        instance = self.model(**kwargs)
+        instance.save(force_insert=True)
+        return instance
+
+    def for_task(self, task: 'Task'):
+        return self.using(task._state.db).filter(task=task)
+
+
 class Task(TimeStampedModel):
     TASK_STATUS_CHOICES = [
         ('OP', 'Open'),
@@ -20,8 +83,77 @@ class Task(TimeStampedModel):
     ]
     title = models.CharField(max_length=255)
     description = models.TextField()
-    status = models.CharField(max_length=100, choices=TASK_STATUS_CHOICES, default='OP')
+    status = models.CharField(max_length=100, choices=TASK_STATUS_CHOICES, default='OP', db_index=True)
     owner = models.ForeignKey(CustomUser, on_delete=models.CASCADE)
+    parent = models.ForeignKey('self', related_name='children', blank=True, null=True, on_delete=models.CASCADE)
+    due_at = models.DateTimeField(blank=True, null=True)
+    due_reminder_sent_at = models.DateTimeField(blank=True, null=True)
+    deleted_at = models.DateTimeField(blank=True, null=True)
+
+    objects = ActiveTaskManager()
+    all_objects = models.Manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['owner', 'status'], name='task_owner_status_idx'),
+            # Only the few tasks waiting for purgedeletedtasks
+            models.Index(fields=['deleted_at'], name='deleted_task_idx', condition=Q(deleted_at__isnull=False)),
+            models.Index(
+                fields=['due_at'],
+                name='open_task_due_idx',
+                condition=Q(due_at__isnull=False, deleted_at__isnull=True) & ~Q(status='CO'),
+            ),
+            models.Index(
+                fields=['due_at'],
+                name='pending_due_reminder_idx',
+                condition=Q(due_at__isnull=False, deleted_at__isnull=True, due_reminder_sent_at__isnull=True) & ~Q(status='CO'),
+            ),
+        ]
+
+    def save(self, *args, **kwargs):
+        using = kwargs.get('using') or router.db_for_write(Task, instance=self)
+
+        with transaction.atomic(using=using):
+            saved = None
+            if self.pk:
+                # Counters and closure links follow the row as it is now, not as this instance loaded it
+                saved = Task.all_objects \
+                    .using(using) \
+                    .select_for_update() \
+                    .filter(pk=self.pk) \
+                    .values_list('status', 'owner_id', 'parent_id', 'deleted_at') \
+                    .first()
+            super().save(*args, **kwargs)
+
+            if saved is None:
+                TaskClosure.objects.using(using).link(self.pk, self.parent_id)
+                TaskStatusCounter.objects.using(using).adjust(self.owner_id, self.status, 1)
+                return
+
+            status, owner_id, parent_id, deleted_at = saved
+            if parent_id != self.parent_id:
+                TaskClosure.objects.using(using).move(self.pk, self.parent_id)
+            if deleted_at is None and (status, owner_id) != (self.status, self.owner_id):
+                TaskStatusCounter.objects.using(using).adjust(owner_id, status, -1)
+                TaskStatusCounter.objects.using(using).adjust(self.owner_id, self.status, 1)
+
+    def mark_deleted(self):
+        """
+        Mark the task deleted. Tasks below it are hidden right away and
+        marked in batches by the purgedeletedtasks command.
+        """
+        using = router.db_for_write(Task, instance=self)
+        now = datetime.now(timezone.utc)
+
+        with transaction.atomic(using=using):
+            task = Task.all_objects.using(using).filter(pk=self.pk)
+            if not task.filter(deleted_at__isnull=True).update(deleted_at=now, updated_at=now):
+                return
+            owner_id, status = task.values_list('owner_id', 'status').get()
+            TaskStatusCounter.objects.using(using).adjust(owner_id, status, -1)
+            Tombstone.objects.using(using).create(model_name=Task._meta.model_name, object_id=self.pk)
+
+        self.deleted_at = now
 
     @property
     def get_task_total_duration(self):
@@ -31,19 +163,150 @@ class Task(TimeStampedModel):
         return total_duration // 60
 
 
+class TaskStatusCounterQuerySet(models.QuerySet):
+
+    def adjust(self, owner_id: int, status: str, delta: int):
+        counters = self.filter(owner_id=owner_id, status=status)
+        # Counts never go below zero, reconciletaskcounters repairs any remaining drift
+        if counters.update(count=Greatest(F('count') + delta, 0)) or delta < 0:
+            return
+
+        _, created = self.get_or_create(owner_id=owner_id, status=status, defaults={'count': delta})
+        if not created:
+            counters.update(count=Greatest(F('count') + delta, 0))
+
+
+class TaskStatusCounter(models.Model):
+    owner = models.ForeignKey(CustomUser, related_name='task_status_counters', on_delete=models.CASCADE)
+    status = models.CharField(max_length=100, choices=Task.TASK_STATUS_CHOICES)
+    count = models.IntegerField(default=0)
+
+    objects = TaskStatusCounterQuerySet.as_manager()
+
+    class Meta:
+        unique_together = ('owner', 'status')
+
+    def __str__(self):
+        return f'{self.owner_id} {self.status}: {self.count}'
+
+
+class TaskClosureQuerySet(models.QuerySet):
+
+    def attach(self, task_id: int, parent_id: int):
+        """
+        Link the subtree of `task_id` below `parent_id` and every ancestor of it.
+        """
+        connection = connections[self.db]
+        table = connection.ops.quote_name(self.model._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {table} (ancestor_id, descendant_id, depth) '
+                f'SELECT supertree.ancestor_id, subtree.descendant_id, supertree.depth + subtree.depth + 1 '
+                f'FROM {table} supertree, {table} subtree '
+                f'WHERE supertree.descendant_id = %s AND subtree.ancestor_id = %s',
+                [parent_id, task_id]
+            )
+
+    def detach(self, task_id: int):
+        """
+        Unlink the subtree of `task_id` from the ancestors of `task_id`.
+        """
+        subtree = self.filter(ancestor_id=task_id).values('descendant_id')
+        self.filter(descendant_id__in=subtree).exclude(ancestor_id__in=subtree).delete()
+
+    def link(self, task_id: int, parent_id: Optional[int]):
+        self.create(ancestor_id=task_id, descendant_id=task_id, depth=0)
+        if parent_id is not None:
+            self.attach(task_id, parent_id)
+
+    def move(self, task_id: int, parent_id: Optional[int]):
+        self.detach(task_id)
+        if parent_id is not None:
+            self.attach(task_id, parent_id)
+
+
+class TaskClosure(models.Model):
+    """
+    Every ancestor/descendant pair of the task hierarchy, each task being its
+    own ancestor at depth 0, so a subtree is read with one indexed join.
+    """
+    ancestor = models.ForeignKey(Task, related_name='descendant_links', on_delete=models.CASCADE)
+    descendant = models.ForeignKey(Task, related_name='ancestor_links', on_delete=models.CASCADE)
+    depth = models.PositiveIntegerField()
+
+    objects = TaskClosureQuerySet.as_manager()
+
+    class Meta:
+        unique_together = ('ancestor', 'descendant')
+
+    def __str__(self):
+        return f'{self.ancestor_id} > {self.descendant_id} at depth {self.depth}'
+
+
 class Comment(TimeStampedModel):
     text = models.TextField()
     task = models.ForeignKey(Task, related_name='comments', on_delete=models.CASCADE)
     author = models.ForeignKey(CustomUser, related_name='comments', on_delete=models.CASCADE)
 
+    objects = ActiveTaskRelatedManager()
+    all_objects = models.Manager()
+
 
 class TaskDuration(TimeStampedModel):
     task = models.ForeignKey(Task, related_name='task_duration', on_delete=models.CASCADE)
     owner = models.ForeignKey(CustomUser, on_delete=models.CASCADE)
-    start_working_datetime = models.DateTimeField(auto_now_add=True)
+    start_working_datetime = models.DateTimeField(default=django_timezone.now, db_index=True)
     stop_working_datetime = models.DateTimeField(blank=True, null=True)
     duration = models.IntegerField(blank=True, null=True)
     timer_on = models.BooleanField(default=True)
+    auto_stopped = models.BooleanField(default=False)
+    last_heartbeat_at = models.DateTimeField(blank=True, null=True)
+
+    objects = ActiveTaskRelatedManager()
+    all_objects = models.Manager()
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=['start_working_datetime'],
+                name='running_timer_start_idx',
+                condition=Q(timer_on=True),
+            ),
+            models.Index(fields=['task'], name='running_timer_task_idx', condition=Q(timer_on=True)),
+            models.Index(fields=['task', 'duration'], name='task_logged_duration_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.task_id} start on {self.start_working_datetime}, duration {self.duration} s.'
+
+
+class Tombstone(models.Model):
+    model_name = models.CharField(max_length=50)
+    object_id = models.BigIntegerField()
+    # Set for time logs, which are only synced to their owner
+    owner_id = models.BigIntegerField(blank=True, null=True)
+    deleted_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self):
+        return f'{self.model_name} {self.object_id} deleted on {self.deleted_at}'
+
+
+class TaskShard(models.Model):
+    """
+    Directory of the shard each task lives on, kept in the default database.
+    """
+    task_id = models.BigIntegerField(primary_key=True)
+    shard = models.CharField(max_length=100)
+
+    def __str__(self):
+        return f'{self.task_id} on {self.shard}'
+
+
+class ShardIdSequence(models.Model):
+    """
+    Hands out primary keys for tasks, comments and time logs that are unique across all shards.
+    """
+    next_id = models.BigIntegerField()
 
     def __str__(self):
-        return f'{self.task.id} start on {self.start_working_datetime}, duration {self.duration} s.'
+        return f'next id {self.next_id}'
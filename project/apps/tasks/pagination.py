@@ -0,0 +1,81 @@
+from collections import OrderedDict
+from typing import Optional
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import QuerySet
+from rest_framework.pagination import LimitOffsetPagination
+from rest_framework.response import Response
+
+
+class EstimatedCountPagination(LimitOffsetPagination):
+    """
+    Limit/offset pagination that reports the planner's row estimate instead of
+    running an exact COUNT(*) once a listing grows past
+    `PAGINATION_ESTIMATE_THRESHOLD` rows.
+    """
+    count_is_exact = True
+
+    def get_count(self, queryset):
+        self.count_is_exact = True
+        if not isinstance(queryset, QuerySet):
+            return super().get_count(queryset)
+
+        queryset = queryset.order_by()
+        threshold = settings.PAGINATION_ESTIMATE_THRESHOLD
+        estimate = self.estimate_count(queryset)
+        if estimate is None or estimate < threshold:
+            return super().get_count(queryset)
+
+        # The estimate may be far off for selective filters, so confirm it
+        # with a count that never reads more than `threshold` rows.
+        bounded_count = queryset[:threshold].count()
+        if bounded_count < threshold:
+            return bounded_count
+
+        self.count_is_exact = False
+        return estimate
+
+    def is_unfiltered(self, queryset: QuerySet) -> bool:
+        """
+        Whether the queryset filters nothing beyond what the model's default manager does.
+        """
+        base_queryset = queryset.model._default_manager.using(queryset.db)
+        return self.compile_where(queryset) == self.compile_where(base_queryset.all())
+
+    @staticmethod
+    def compile_where(queryset: QuerySet) -> tuple:
+        compiler = queryset.query.get_compiler(using=queryset.db)
+        sql, params = compiler.compile(queryset.query.where)
+        return sql, tuple(params)
+
+    def estimate_count(self, queryset: QuerySet) -> Optional[int]:
+        connection = connections[queryset.db]
+        table = queryset.model._meta.db_table
+        is_unfiltered = self.is_unfiltered(queryset)
+
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                if is_unfiltered:
+                    cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass', [table])
+                    estimate = cursor.fetchone()[0]
+                    return estimate if estimate >= 0 else None
+
+                sql, params = queryset.query.get_compiler(using=queryset.db).as_sql()
+                cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+                return cursor.fetchone()[0][0]['Plan']['Plan Rows']
+
+            if connection.vendor == 'sqlite' and is_unfiltered:
+                cursor.execute(f'SELECT MAX(rowid) FROM {connection.ops.quote_name(table)}')
+                return cursor.fetchone()[0] or 0
+
+        return None
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('count', self.count),
+            ('count_is_exact', self.count_is_exact),
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data)
+        ]))
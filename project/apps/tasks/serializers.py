@@ -1,20 +1,90 @@
 from datetime import datetime, timezone
+from typing import List, Optional
 
 from rest_framework import serializers
 
-from .models import Task, Comment, TaskDuration
+from .models import Task, TaskClosure, Comment, TaskDuration
 from .service import send_user_email, get_all_commentators
+from .sharding import shard_for_owner
 from apps.users.models import CustomUser
+from apps.users.serializers import UserSerializer
 
 
-class ListTaskSerializer(serializers.ModelSerializer):
+def parse_query_list(value) -> List[str]:
+    return [item.strip() for item in (value or '').split(',') if item.strip()]
+
+
+def get_parent_task(parent_id: Optional[int], shard: str, task: Optional[Task] = None) -> Optional[Task]:
+    """
+    Resolve the parent of a task stored on `shard`, refusing parents that
+    would put the task below itself.
+    """
+    if parent_id is None:
+        return None
+
+    parent = Task.objects.for_task(parent_id).filter(pk=parent_id).first()
+    if parent is None:
+        raise serializers.ValidationError('Task does not exist.')
+    if parent._state.db != shard:
+        raise serializers.ValidationError('Parent task must be stored on the same shard as the task.')
+    if task is not None and TaskClosure.objects.using(shard).filter(ancestor=task, descendant=parent).exists():
+        raise serializers.ValidationError('A task cannot be moved below itself.')
+    return parent
+
+
+class CommentSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Comment
+        fields = ('id', 'text')
+
+    def create(self, validated_data):
+        validated_data['task'] = self.context['task']
+        validated_data['author'] = self.context['user']
+        send_user_email(self.context['user'].email, 'comment')
+
+        return Comment.objects.create(**validated_data)
+
+
+class SparseFieldsetMixin:
+    """
+    Narrows the representation to the comma separated `?fields=` and replaces
+    the relations named in `?expand=` with their nested representation.
+    """
+    expandable_fields = {
+        'owner': lambda: UserSerializer(read_only=True),
+        'comments': lambda: CommentSerializer(many=True, read_only=True),
+    }
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        request = self.context.get('request')
+        if request is None or request.method != 'GET':
+            return
+
+        expand = [name for name in parse_query_list(request.query_params.get('expand'))
+                  if name in self.expandable_fields]
+        for name in expand:
+            self.fields[name] = self.expandable_fields[name]()
+
+        fields = parse_query_list(request.query_params.get('fields'))
+        if fields:
+            for name in set(self.fields) - set(fields) - set(expand):
+                self.fields.pop(name)
+
+
+class ListTaskSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     user = serializers.PrimaryKeyRelatedField(read_only=True)
     task_duration = serializers.CharField(source='get_task_total_duration', read_only=True)
     description = serializers.CharField(write_only=True)
+    parent = serializers.IntegerField(write_only=True, required=False, allow_null=True)
+    due_at = serializers.DateTimeField(write_only=True, required=False, allow_null=True)
 
     class Meta:
         model = Task
-        fields = ('id', 'title', 'user', 'description', 'task_duration')
+        fields = ('id', 'title', 'user', 'description', 'task_duration', 'parent', 'due_at')
+
+    def validate_parent(self, value):
+        return get_parent_task(value, shard_for_owner(self.context['request'].user.pk))
 
     def create(self, validated_data):
         user = CustomUser.objects.get(id=validated_data['owner'].id)
@@ -23,23 +93,29 @@ class ListTaskSerializer(serializers.ModelSerializer):
         return Task.objects.create(**validated_data)
 
 
-class RetrieveTaskSerializer(serializers.ModelSerializer):
+class RetrieveTaskSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     class Meta:
         model = Task
-        fields = ('id', 'title', 'description', 'status', 'owner')
+        fields = ('id', 'title', 'description', 'status', 'owner', 'due_at')
 
 
-class CommentSerializer(serializers.ModelSerializer):
-    class Meta:
-        model = Comment
-        fields = ('id', 'text')
+class MoveTaskSerializer(serializers.Serializer):
+    parent = serializers.IntegerField(allow_null=True)
 
-    def create(self, validated_data):
-        validated_data['task'] = self.context['task']
-        validated_data['author'] = self.context['user']
-        send_user_email(self.context['user'].email, 'comment')
+    def validate_parent(self, value):
+        task = self.context['task']
+        return get_parent_task(value, task._state.db, task)
 
-        return Comment.objects.create(**validated_data)
+
+class DueDateSerializer(serializers.Serializer):
+    due_at = serializers.DateTimeField(allow_null=True)
+
+
+class ImportTimeLogSerializer(serializers.Serializer):
+    task = serializers.IntegerField()
+    start_working_datetime = serializers.DateTimeField()
+    # In minutes, stored in seconds in a 32 bit integer column
+    duration = serializers.IntegerField(min_value=0, max_value=(2 ** 31 - 1) // 60)
 
 
 class AddTimeOnSpecificDateSerializer(serializers.ModelSerializer):
@@ -1,8 +1,39 @@
+from datetime import datetime, timezone
+import base64
+import binascii
+import json
+import time
+from operator import itemgetter
+from django.conf import settings
+from django.core.cache import cache
 from django.core.mail import EmailMessage
-from typing import List, Union
+from django.core.exceptions import ValidationError
+from django.db.models import Q, QuerySet
+from typing import Dict, List, Tuple, Union
 from collections.abc import Iterable
 
-from .models import Task, Comment
+from .metrics import EMAIL_SEND_DURATION
+from .models import Task, Comment, TaskDuration, Tombstone
+from .sharding import gather
+
+TIMER_HEARTBEAT_KEY = 'timer:heartbeat:{owner_id}:{task_id}'
+TIMER_STOPPED_KEY = 'timer:stopped:{owner_id}:{task_id}'
+# How long a client keeps being told its timer was stopped, unless it starts a new one
+TIMER_STOPPED_TIMEOUT = 24 * 60 * 60
+
+# Models synced by /tasks/sync/ and the fields their rows are ordered and paged
+# by, the last one being unique across shards
+SYNC_STREAMS = {
+    'tasks': (Task, ('updated_at', 'id')),
+    'comments': (Comment, ('updated_at', 'id')),
+    'time_logs': (TaskDuration, ('updated_at', 'id')),
+    'deleted': (Tombstone, ('deleted_at', 'model_name', 'object_id')),
+}
+SYNC_DELETED_KEYS = {
+    Task._meta.model_name: 'tasks',
+    Comment._meta.model_name: 'comments',
+    TaskDuration._meta.model_name: 'time_logs',
+}
 
 email_data = {
     'comment': {
@@ -16,6 +47,10 @@ email_data = {
     'completed': {
         'subject': 'Task completed',
         'message': 'The task you commented on has been changed to the complete state!!!'
+    },
+    'due': {
+        'subject': 'Task due soon',
+        'message': 'Hello, a task assigned to you is due soon!!!'
     }
 }
 
@@ -30,12 +65,155 @@ def send_user_email(emails: Union[List[str], str], message_type: str):
         email_data[message_type]['message'],
         to=emails,
     )
-    email.send()
+    with EMAIL_SEND_DURATION.time(message_type):
+        email.send()
 
 
 def get_all_commentators(task_id: int) -> List[str]:
-    task = Task.objects.get(id=task_id)
-    comments = Comment.objects.select_related('author').filter(task=task)
+    task = Task.objects.for_task(task_id).get(id=task_id)
+    comments = Comment.objects.for_task(task).select_related('author')
     email_list = set(comment.author.email for comment in comments)
 
     return list(email_list)
+
+
+def keyset_after(fields: Tuple[str, ...], position: list) -> Q:
+    """
+    Match rows ordered after `position` by `fields`, like (a, b) > (x, y) in SQL.
+    """
+    condition = Q()
+    for index, field in enumerate(fields):
+        condition |= Q(**dict(zip(fields[:index], position)), **{f'{field}__gt': position[index]})
+    return condition
+
+
+def encode_sync_cursor(positions: Dict[str, list]) -> str:
+    positions = {
+        key: [value.isoformat() if isinstance(value, datetime) else value for value in position]
+        for key, position in positions.items()
+    }
+    return base64.urlsafe_b64encode(json.dumps(positions).encode()).decode()
+
+
+def decode_sync_cursor(cursor: str) -> Dict[str, list]:
+    """
+    Return the position of every sync stream stored in `cursor`, raising
+    ValueError when it is not a cursor returned by `get_changes_since`.
+    """
+    try:
+        positions = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, UnicodeError, ValueError):
+        raise ValueError('Malformed sync cursor')
+    if not isinstance(positions, dict) or set(positions) - set(SYNC_STREAMS):
+        raise ValueError('Malformed sync cursor')
+
+    for key, position in positions.items():
+        model, fields = SYNC_STREAMS[key]
+        if not isinstance(position, list) or len(position) != len(fields):
+            raise ValueError('Malformed sync cursor')
+        # Each value must be of its field's type, like the id of a row and not an object
+        if not all(isinstance(value, (str, int)) and not isinstance(value, bool) for value in position):
+            raise ValueError('Malformed sync cursor')
+        try:
+            positions[key] = [model._meta.get_field(field).to_python(value) for field, value in zip(fields, position)]
+        except (TypeError, ValueError, ValidationError):
+            raise ValueError('Malformed sync cursor')
+        if not isinstance(positions[key][0], datetime):
+            raise ValueError('Malformed sync cursor')
+    return positions
+
+
+def get_synced_rows(user) -> Dict[str, QuerySet]:
+    """
+    Return the rows of every sync stream `user` may see, time logs are only
+    synced to their owner.
+    """
+    return {
+        'tasks': Task.objects.all(),
+        'comments': Comment.objects.all(),
+        'time_logs': TaskDuration.objects.filter(owner=user),
+        'deleted': Tombstone.objects.filter(Q(owner_id=user.pk) | ~Q(model_name=TaskDuration._meta.model_name)),
+    }
+
+
+def get_changes_since(user, positions: Dict[str, list]) -> dict:
+    """
+    Return the next page of rows `user` may see changed after `positions`, as
+    decoded from the cursor of a previous sync, or of every row when empty.
+
+    Each stream is read in (timestamp, id) order, at most SYNC_PAGE_SIZE rows
+    at a time, and its position only advances to the last row served. Rows
+    changed within the last SYNC_WATERMARK_MARGIN are held back for a later
+    sync, as their transaction may not have committed yet, or an earlier one
+    still commit behind them.
+    """
+    until = datetime.now(timezone.utc) - settings.SYNC_WATERMARK_MARGIN
+    page_size = settings.SYNC_PAGE_SIZE
+    positions = dict(positions)
+
+    changes = {}
+    has_more = False
+    synced_rows = get_synced_rows(user)
+    for key, (_, fields) in SYNC_STREAMS.items():
+        queryset = synced_rows[key].filter(**{f'{fields[0]}__lt': until})
+        if key in positions:
+            queryset = queryset.filter(keyset_after(fields, positions[key]))
+
+        # Each shard returns its first page, the merged first page is among them
+        ordering = itemgetter(*fields)
+        rows = sorted(gather(queryset.order_by(*fields).values()[:page_size + 1]), key=ordering)
+        has_more = has_more or len(rows) > page_size
+        changes[key] = rows = rows[:page_size]
+        if rows:
+            positions[key] = list(ordering(rows[-1]))
+
+    deleted = {key: [] for key in ('tasks', 'comments', 'time_logs')}
+    for tombstone in changes['deleted']:
+        deleted[SYNC_DELETED_KEYS[tombstone['model_name']]].append(tombstone['object_id'])
+    changes['deleted'] = deleted
+
+    changes['watermark'] = encode_sync_cursor(positions)
+    changes['has_more'] = has_more
+    return changes
+
+
+def record_timer_heartbeat(owner_id: int, task_id):
+    cache.set(
+        TIMER_HEARTBEAT_KEY.format(owner_id=owner_id, task_id=task_id),
+        time.time(),
+        timeout=settings.TIMER_HEARTBEAT_TIMEOUT
+    )
+
+
+def mark_timers_stopped(timers: List[tuple]):
+    """
+    Remember that the timers of the given (owner_id, task_id) pairs were
+    stopped, so their heartbeats are refused without a database query.
+    """
+    cache.set_many(
+        {TIMER_STOPPED_KEY.format(owner_id=owner_id, task_id=task_id): True for owner_id, task_id in timers},
+        timeout=TIMER_STOPPED_TIMEOUT
+    )
+
+
+def clear_timer_stopped(owner_id: int, task_id):
+    cache.delete(TIMER_STOPPED_KEY.format(owner_id=owner_id, task_id=task_id))
+
+
+def is_timer_stopped(owner_id: int, task_id) -> bool:
+    return cache.get(TIMER_STOPPED_KEY.format(owner_id=owner_id, task_id=task_id), False)
+
+
+def get_timer_heartbeats(timers: List[tuple]) -> Dict[int, datetime]:
+    """
+    Map the ids of timers, given as (id, owner_id, task_id) rows, to the time
+    of their last heartbeat, reading every heartbeat with one cache round trip.
+    """
+    keys = {
+        TIMER_HEARTBEAT_KEY.format(owner_id=owner_id, task_id=task_id): timer_id
+        for timer_id, owner_id, task_id in timers
+    }
+    return {
+        keys[key]: datetime.fromtimestamp(timestamp, timezone.utc)
+        for key, timestamp in cache.get_many(keys).items()
+    }
@@ -0,0 +1,243 @@
+"""
+Owner based sharding of task data.
+
+Every alias listed in `TASK_SHARDS` holds a full copy of the schema. A task
+lives on the shard picked by `shard_for_owner` when it is created, and its
+comments, time logs, status counters and tombstones follow it. Users are
+written to the default database and copied to every shard, so foreign keys
+never cross databases. Task ids are recorded in the `TaskShard` directory so
+`/tasks/<id>/` resolves its shard with one primary key read.
+
+With a single shard every helper here degrades to plain default-database
+behaviour without extra queries.
+"""
+import heapq
+import os
+import threading
+from collections import defaultdict
+from itertools import chain, islice
+from typing import Dict, Iterable, List, Optional
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import F, Max, QuerySet
+
+
+def get_shards() -> List[str]:
+    return settings.TASK_SHARDS
+
+
+def is_sharded() -> bool:
+    return len(settings.TASK_SHARDS) > 1
+
+
+def shard_for_owner(owner_id: int) -> str:
+    shards = get_shards()
+    return shards[owner_id % len(shards)]
+
+
+def shard_for_task(task_id) -> Optional[str]:
+    if not is_sharded():
+        return DEFAULT_DB_ALIAS
+
+    from .models import TaskShard
+
+    try:
+        return TaskShard.objects.filter(task_id=task_id).values_list('shard', flat=True).first()
+    except (TypeError, ValueError):
+        return None
+
+
+def shards_for_tasks(task_ids: Iterable[int]) -> Dict[int, str]:
+    """
+    Map the ids of existing tasks to their shard, with one query per shard
+    plus one directory read.
+    """
+    from .models import Task, TaskShard
+
+    task_ids_by_shard = defaultdict(list)
+    if is_sharded():
+        for task_id, shard in TaskShard.objects.filter(task_id__in=task_ids).values_list('task_id', 'shard'):
+            task_ids_by_shard[shard].append(task_id)
+    else:
+        task_ids_by_shard[DEFAULT_DB_ALIAS] = list(task_ids)
+
+    return {
+        task_id: shard
+        for shard, shard_task_ids in task_ids_by_shard.items()
+        for task_id in Task.objects.using(shard).filter(pk__in=shard_task_ids).values_list('pk', flat=True)
+    }
+
+
+def scatter(queryset: QuerySet) -> List[QuerySet]:
+    if not is_sharded():
+        return [queryset]
+    return [queryset.using(shard) for shard in get_shards()]
+
+
+def gather(queryset: QuerySet) -> list:
+    return list(chain.from_iterable(scatter(queryset)))
+
+
+class ScatterGatherQuerySet:
+    """
+    The same query run on every shard, merged in primary key order.
+
+    Only supports what list endpoints need: `count()`, iteration and slicing.
+    A slice reads at most `stop` rows from each shard.
+    """
+
+    def __init__(self, querysets: Iterable[QuerySet]):
+        self.querysets = [queryset.order_by('pk') for queryset in querysets]
+
+    def count(self) -> int:
+        return sum(queryset.count() for queryset in self.querysets)
+
+    def __len__(self):
+        return self.count()
+
+    def __iter__(self):
+        return heapq.merge(*self.querysets, key=lambda instance: instance.pk)
+
+    def __getitem__(self, item):
+        if not isinstance(item, slice):
+            return self[item:item + 1][0]
+
+        querysets = self.querysets
+        if item.stop is not None:
+            querysets = [queryset[:item.stop] for queryset in querysets]
+        merged = heapq.merge(*querysets, key=lambda instance: instance.pk)
+        return list(islice(merged, item.start, item.stop))
+
+
+def get_max_sharded_id() -> int:
+    from .models import Task, Comment, TaskDuration
+
+    max_ids = [
+        model._base_manager.using(shard).aggregate(max_id=Max('pk'))['max_id'] or 0
+        for model in (Task, Comment, TaskDuration)
+        for shard in get_shards()
+    ]
+    return max(max_ids)
+
+
+def allocate_ids(count: int) -> range:
+    from .models import ShardIdSequence
+
+    with transaction.atomic(using=DEFAULT_DB_ALIAS):
+        sequence, _ = ShardIdSequence.objects.select_for_update().get_or_create(
+            pk=1, defaults={'next_id': lambda: get_max_sharded_id() + 1}
+        )
+        ShardIdSequence.objects.filter(pk=sequence.pk).update(next_id=F('next_id') + count)
+
+    return range(sequence.next_id, sequence.next_id + count)
+
+
+class IdBlock:
+    """
+    Ids this process reserved from the shared sequence in blocks of
+    SHARD_ID_BLOCK_SIZE, so inserts on any shard only lock the sequence row
+    in the default database once per block.
+
+    The unused rest of a block is kept only once the transaction that
+    reserved it commits, a rolled back reservation is handed out again.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pid = None
+        self.ids = range(0)
+
+    def take(self, count: int) -> List[int]:
+        with self.lock:
+            if self.pid != os.getpid():
+                # Forked, the ids left to the parent process are not ours
+                self.pid, self.ids = os.getpid(), range(0)
+            ids = list(self.ids[:count])
+            self.ids = self.ids[count:]
+
+        missing = count - len(ids)
+        if missing:
+            block = allocate_ids(max(missing, settings.SHARD_ID_BLOCK_SIZE))
+            ids.extend(block[:missing])
+            transaction.on_commit(lambda: self.keep(block[missing:]), using=DEFAULT_DB_ALIAS)
+        return ids
+
+    def keep(self, ids: range):
+        with self.lock:
+            if self.pid == os.getpid():
+                self.ids = ids
+
+
+id_block = IdBlock()
+
+
+def assign_shard_ids(instances: list, shard: str):
+    """
+    Give unsaved tasks, comments or time logs primary keys unique across shards,
+    registering tasks in the shard directory. Needed before `bulk_create`.
+    """
+    if not is_sharded() or not instances:
+        return
+
+    from .models import Task, TaskShard
+
+    for instance, pk in zip(instances, id_block.take(len(instances))):
+        instance.pk = pk
+
+    tasks = [instance for instance in instances if isinstance(instance, Task)]
+    TaskShard.objects.bulk_create([TaskShard(task_id=task.pk, shard=shard) for task in tasks])
+
+
+def copy_user_to_shards(user):
+    for shard in get_shards():
+        if shard != DEFAULT_DB_ALIAS:
+            user.save_base(using=shard, raw=True)
+    user._state.db = DEFAULT_DB_ALIAS
+
+
+class TaskShardRouter:
+    """
+    Routes task data to the shard of the instance it is saved with or read through.
+
+    Reads without an instance hint go to the default database; callers that
+    need every shard use `scatter`/`gather` or the `for_owner`/`for_task`
+    manager methods.
+    """
+
+    def db_for_read(self, model, **hints):
+        return self.get_shard(model, **hints)
+
+    def db_for_write(self, model, **hints):
+        if is_sharded() and model._meta.label == settings.AUTH_USER_MODEL:
+            # Copied to the other shards by apps.tasks.signals.replicate_user
+            return DEFAULT_DB_ALIAS
+        return self.get_shard(model, **hints)
+
+    def get_shard(self, model, instance=None, **hints):
+        if not is_sharded():
+            return None
+
+        from .models import Task, Comment, TaskDuration, TaskShard, ShardIdSequence
+
+        if model in (TaskShard, ShardIdSequence):
+            return DEFAULT_DB_ALIAS
+        if instance is None or instance._meta.label == settings.AUTH_USER_MODEL:
+            # Users exist on every shard, so they say nothing about where task data lives
+            return None
+
+        # New rows may carry the database of a related user, so place them by their own fields
+        if instance._state.adding and isinstance(instance, Task):
+            return shard_for_owner(instance.owner_id)
+        if instance._state.adding and isinstance(instance, (Comment, TaskDuration)):
+            task = instance._state.fields_cache.get('task')
+            if task is not None and not task._state.adding:
+                return task._state.db
+            return shard_for_task(instance.task_id)
+        return instance._state.db
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if is_sharded():
+            # Users are copied to every shard, everything else stays on its task's shard
+            return True
+        return None
@@ -0,0 +1,59 @@
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+
+from apps.users.models import CustomUser
+from .models import Task, Comment, TaskDuration, TaskShard, TaskStatusCounter, Tombstone
+from .sharding import assign_shard_ids, copy_user_to_shards, get_shards, is_sharded
+
+
+@receiver(post_delete, sender=Task)
+@receiver(post_delete, sender=Comment)
+@receiver(post_delete, sender=TaskDuration)
+def record_tombstone(sender, instance, using, **kwargs):
+    Tombstone.objects.using(using).create(
+        model_name=sender._meta.model_name,
+        object_id=instance.pk,
+        owner_id=instance.owner_id if sender is TaskDuration else None,
+    )
+
+
+@receiver(post_delete, sender=Task)
+def unregister_task_shard(sender, instance, **kwargs):
+    # Also reached through the cascade of a deleted owner
+    if is_sharded():
+        TaskShard.objects.filter(task_id=instance.pk).delete()
+
+
+@receiver(post_delete, sender=Task)
+def decrement_status_counter(sender, instance, using, **kwargs):
+    if instance.deleted_at is not None:
+        # Already uncounted by Task.mark_deleted
+        return
+    TaskStatusCounter.objects.using(using).adjust(instance.owner_id, instance.status, -1)
+
+
+@receiver(pre_save, sender=Task)
+@receiver(pre_save, sender=Comment)
+@receiver(pre_save, sender=TaskDuration)
+def assign_shard_id(sender, instance, raw, using, **kwargs):
+    if instance.pk is None and not raw:
+        assign_shard_ids([instance], using)
+
+
+@receiver(post_save, sender=CustomUser)
+def replicate_user(sender, instance, raw, using, **kwargs):
+    if raw or not is_sharded() or using != DEFAULT_DB_ALIAS:
+        return
+
+    copy_user_to_shards(instance)
+
+
+@receiver(post_delete, sender=CustomUser)
+def delete_replicated_user(sender, instance, using, **kwargs):
+    if not is_sharded() or using != DEFAULT_DB_ALIAS:
+        return
+
+    for shard in get_shards():
+        if shard != DEFAULT_DB_ALIAS:
+            CustomUser.objects.using(shard).filter(pk=instance.pk).delete()
@@ -1,15 +1,42 @@
-from datetime import datetime, timezone
+from datetime import datetime, timezone, timedelta
+import base64
+import io
 import json
-
+import tempfile
+from unittest import mock, skipUnless
+
+from django.conf import settings
+
+from django.core import mail
+from django.core.mail.backends import locmem
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import DEFAULT_DB_ALIAS, DataError, connection, connections
+from django.db.models import QuerySet
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from rest_framework import status
 from rest_framework.test import APITestCase
 from rest_framework_simplejwt.tokens import RefreshToken
 
-from apps.tasks.models import Task, Comment, TaskDuration
+from apps.tasks.imports import import_time_logs
+from apps.tasks.metrics import REQUESTS
+from apps.tasks.models import Task, TaskClosure, TaskShard, Comment, TaskDuration, TaskStatusCounter, Tombstone
+from apps.tasks.sharding import IdBlock, shard_for_owner
+from apps.tasks.throttling import get_throttle_counters
 from apps.users.models import CustomUser
 
 
+class FailingEmailBackend(locmem.EmailBackend):
+
+    def send_messages(self, messages):
+        if any('aaa.asdas@gmail.cov' in message.to for message in messages):
+            raise OSError('Connection refused')
+        return super().send_messages(messages)
+
+
 class TaskViewSetTest(APITestCase):
 
     def setUp(self) -> None:
@@ -24,6 +51,7 @@ class TaskViewSetTest(APITestCase):
         refresh = RefreshToken.for_user(self.user)
         self.access_token = str(refresh.access_token)
         self.api_authentification()
+        cache.clear()
 
     def api_authentification(self):
         self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.access_token)
@@ -57,6 +85,7 @@ class TaskViewSetTest(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(json.loads(response.content), {
                             "count": 1,
+                            "count_is_exact": True,
                             "next": None,
                             "previous": None,
                             "results": [{
@@ -77,6 +106,7 @@ class TaskViewSetTest(APITestCase):
             'description': 'Some description',
             'status': 'OP',
             'owner': 1,
+            'due_at': None,
         })
 
     def test_my_tasks(self):
@@ -123,6 +153,83 @@ class TaskViewSetTest(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(json.loads(response.content), {'detail': 'success',})
 
+    def test_request_metrics(self):
+        requests = REQUESTS.get('list', 200)
+        self.client.get('/tasks/')
+        self.assertEqual(REQUESTS.get('list', 200), requests + 1)
+
+    def test_overdue_tasks(self):
+        now = datetime.now(timezone.utc)
+        for title, due_at in (('overdue', now - timedelta(days=1)), ('upcoming', now + timedelta(days=1)), ('none', None)):
+            response = self.client.post('/tasks/', {'title': title, 'description': 'Some description', 'due_at': due_at}, format='json')
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        response = self.client.get('/tasks/?overdue=true&fields=title')
+        self.assertEqual(json.loads(response.content)['results'], [{'title': 'overdue'}])
+        response = self.client.get('/tasks/?overdue=false&fields=title')
+        self.assertEqual(json.loads(response.content)['results'], [{'title': 'upcoming'}, {'title': 'none'}])
+
+        self.client.patch('/tasks/1/complete/')
+        response = self.client.get('/tasks/?overdue=true')
+        self.assertEqual(json.loads(response.content)['results'], [])
+        response = self.client.get('/tasks/?overdue=false')
+        self.assertEqual(len(json.loads(response.content)['results']), 3)
+
+    def test_send_due_reminders(self):
+        now = datetime.now(timezone.utc)
+        self.insert_one_task('Due soon', 'Some description')
+        self.insert_one_task('Due later', 'Some description')
+        self.client.patch('/tasks/1/due/', {'due_at': (now + timedelta(minutes=10)).isoformat()}, format='json')
+        self.client.patch('/tasks/2/due/', {'due_at': (now + timedelta(days=2)).isoformat()}, format='json')
+
+        call_command('sendduereminders', stdout=io.StringIO())
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, [self.user.email])
+        self.assertEqual(list(Task.objects.filter(due_reminder_sent_at__isnull=False).values_list('id', flat=True)), [1])
+
+        call_command('sendduereminders', stdout=io.StringIO())
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_send_due_reminders_with_failing_email(self):
+        due_at = datetime.now(timezone.utc) + timedelta(minutes=10)
+        for user in (self.user, self.user2, CustomUser.objects.create(email='ccc.asdas@gmail.com', password='1234')):
+            Task.objects.create(owner=user, title='Due soon', description='Some description', due_at=due_at)
+
+        stderr = io.StringIO()
+        with override_settings(EMAIL_BACKEND='apps.tasks.tests.FailingEmailBackend'):
+            call_command('sendduereminders', batch_size=2, stdout=io.StringIO(), stderr=stderr)
+        self.assertEqual(sorted(email.to[0] for email in mail.outbox), [self.user.email, 'ccc.asdas@gmail.com'])
+        self.assertIn(self.user2.email, stderr.getvalue())
+        self.assertEqual(list(Task.objects.filter(due_reminder_sent_at__isnull=True).values_list('id', flat=True)), [2])
+
+        # Only the failed reminder is sent again
+        call_command('sendduereminders', stdout=io.StringIO())
+        self.assertEqual([email.to for email in mail.outbox[2:]], [[self.user2.email]])
+
+    def test_filter_tasks(self):
+        for title in ('first', 'second', 'third'):
+            self.insert_one_task(title, 'Some description')
+        Task.objects.filter(pk=3).update(owner=self.user2)
+        self.client.patch('/tasks/2/complete/')
+        TaskDuration.objects.create(owner=self.user, task_id=1, duration=1200, timer_on=False)
+        TaskDuration.objects.create(owner=self.user, task_id=1, duration=600, timer_on=False)
+        TaskDuration.objects.create(owner=self.user, task_id=2, duration=600)
+
+        def titles(query: str) -> list:
+            response = self.client.get(f'/tasks/?fields=title&{query}')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            return [task['title'] for task in json.loads(response.content)['results']]
+
+        self.assertEqual(titles('status=OP'), ['first', 'third'])
+        self.assertEqual(titles('status=OP&status=CO'), ['first', 'second', 'third'])
+        self.assertEqual(titles(f'owner={self.user2.pk}'), ['third'])
+        self.assertEqual(titles('has_running_timer=true'), ['second'])
+        self.assertEqual(titles('has_running_timer=false&status=OP'), ['first', 'third'])
+        self.assertEqual(titles('min_logged_time=30'), ['first'])
+        self.assertEqual(titles('min_logged_time=10&search=sec'), ['second'])
+        self.assertEqual(titles(f'created_before={datetime(2000, 1, 1).isoformat()}'), [])
+        self.assertEqual(self.client.get('/tasks/?status=XX').status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_remove_task(self):
         self.insert_one_task('Task title', 'Some description')
         url = '/tasks/1/'
@@ -130,6 +237,115 @@ class TaskViewSetTest(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
         self.assertEqual(Task.objects.all().count(), 0)
 
+    def test_purge_deleted_task(self):
+        self.insert_one_task('Task title', 'Some description')
+        task = Task.objects.get()
+        Comment.objects.bulk_create([Comment(text='Some comment text', task=task, author=self.user) for _ in range(3)])
+        TaskDuration.objects.create(owner=self.user, task=task)
+
+        self.client.delete('/tasks/1/')
+        self.assertEqual(Comment.objects.count(), 0)
+        self.assertEqual(Comment.all_objects.count(), 3)
+        self.assertEqual(self.client.get('/tasks/1/').status_code, status.HTTP_404_NOT_FOUND)
+
+        call_command('purgedeletedtasks', batch_size=2, stdout=io.StringIO())
+
+        self.assertEqual(Task.all_objects.count(), 0)
+        self.assertEqual(Comment.all_objects.count(), 0)
+        self.assertEqual(TaskDuration.all_objects.count(), 0)
+        self.assertEqual(Tombstone.objects.filter(model_name='comment').count(), 3)
+        self.assertEqual(Tombstone.objects.filter(model_name='task').count(), 1)
+
+    def insert_task_tree(self):
+        # 1 > 2 > 3 and 1 > 4
+        self.insert_one_task('Root', 'Some description')
+        for parent in (1, 2, 1):
+            response = self.client.post('/tasks/', {'title': 'Child', 'description': 'Some description', 'parent': parent})
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+    def test_task_subtree(self):
+        self.insert_task_tree()
+        response = self.client.get('/tasks/2/subtree/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(response.content)['results'], [
+            {'id': 2, 'title': 'Child', 'status': 'OP', 'parent': 1, 'depth': 0},
+            {'id': 3, 'title': 'Child', 'status': 'OP', 'parent': 2, 'depth': 1},
+        ])
+
+        response = self.client.get('/tasks/1/subtree/?max_depth=1')
+        self.assertEqual([task['id'] for task in json.loads(response.content)['results']], [1, 2, 4])
+
+    def test_task_rollup(self):
+        self.insert_task_tree()
+        TaskDuration.objects.create(owner=self.user, task_id=3, duration=600, timer_on=False)
+        TaskDuration.objects.create(owner=self.user, task_id=4, duration=300, timer_on=False)
+        self.client.patch('/tasks/3/complete/')
+
+        response = self.client.get('/tasks/1/rollup/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(response.content), {
+            'tasks': 4,
+            'statuses': {'OP': 3, 'IP': 0, 'PA': 0, 'CO': 1},
+            'task_duration': 15,
+        })
+
+    def test_move_task(self):
+        self.insert_task_tree()
+        response = self.client.patch('/tasks/1/move/', {'parent': 3})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.client.patch('/tasks/2/move/', {'parent': 4})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            set(TaskClosure.objects.filter(descendant_id=3).values_list('ancestor_id', 'depth')),
+            {(3, 0), (2, 1), (4, 2), (1, 3)}
+        )
+
+        response = self.client.patch('/tasks/2/move/', {'parent': None}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(set(TaskClosure.objects.filter(descendant_id=3).values_list('ancestor_id', flat=True)), {2, 3})
+
+        TaskClosure.objects.all().delete()
+        call_command('rebuildtaskclosure', stdout=io.StringIO())
+        self.assertEqual(TaskClosure.objects.count(), 6)
+
+    def test_remove_task_subtree(self):
+        self.insert_task_tree()
+        Comment.objects.create(text='Some comment text', task=Task.objects.get(pk=3), author=self.user)
+        self.client.delete('/tasks/2/')
+
+        # Only the root is marked, the task below it is hidden with its comments
+        self.assertEqual(list(Task.objects.values_list('id', flat=True)), [1, 4])
+        self.assertEqual(Comment.objects.count(), 0)
+        self.assertEqual(list(Task.all_objects.filter(deleted_at__isnull=False).values_list('id', flat=True)), [2])
+        self.assertEqual(TaskStatusCounter.objects.get(owner=self.user, status='OP').count, 3)
+        self.assertEqual(self.client.get('/tasks/3/').status_code, status.HTTP_404_NOT_FOUND)
+
+        call_command('purgedeletedtasks', batch_size=1, stdout=io.StringIO())
+        self.assertEqual(Task.all_objects.count(), 2)
+        self.assertEqual(TaskClosure.objects.count(), 3)
+        self.assertEqual(TaskStatusCounter.objects.get(owner=self.user, status='OP').count, 2)
+        self.assertEqual(
+            sorted(Tombstone.objects.filter(model_name='task').values_list('object_id', flat=True)), [2, 3]
+        )
+
+    def test_remove_deep_task_chain(self):
+        self.insert_one_task('Root', 'Some description')
+        parent = Task.objects.get()
+        for _ in range(50):
+            parent = Task.objects.create(owner=self.user, title='Child', description='Some description', parent=parent)
+        Comment.objects.create(text='Some comment text', task=parent, author=self.user)
+        self.insert_one_task('Unrelated', 'Some description')
+
+        self.client.delete('/tasks/1/')
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(list(Task.objects.values_list('title', flat=True)), ['Unrelated'])
+            self.assertFalse(Comment.objects.exists())
+        # Deleted tasks are looked up once per query rather than through the ancestors of every row
+        self.assertEqual(len(queries), 2)
+        self.assertNotIn('EXISTS', queries[0]['sql'])
+
     def test_add_comment(self):
         self.insert_one_task('Task title', 'Some description')
         url = '/tasks/1/comments/'
@@ -167,6 +383,7 @@ class TaskViewSetTest(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(json.loads(response.content), {
                             "count": 1,
+                            "count_is_exact": True,
                             "next": None,
                             "previous": None,
                             "results": [{
@@ -176,6 +393,201 @@ class TaskViewSetTest(APITestCase):
                             }]}
                          )
 
+    def test_task_retrieve_fields(self):
+        self.insert_one_task('Task title', 'Some description')
+        url = '/tasks/1/?fields=title,status'
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(response.content), {
+            'title': 'Task title',
+            'status': 'OP',
+        })
+        self.assertNotIn('description', queries[-1]['sql'])
+
+    def test_task_retrieve_expand(self):
+        self.insert_one_task('Task title', 'Some description')
+        Comment.objects.create(task_id=1, author=self.user, text='Some comment')
+        url = '/tasks/1/?fields=id&expand=owner,comments'
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(response.content), {
+            'id': 1,
+            'owner': {'id': self.user.id, 'full_name': ' '},
+            'comments': [{'id': 1, 'text': 'Some comment'}],
+        })
+
+    def test_task_list_ids(self):
+        for title in ('first', 'second', 'third'):
+            self.insert_one_task(title, 'Some description')
+
+        url = '/tasks/?ids=1,3&fields=title'
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(response.content)['results'], [{'title': 'first'}, {'title': 'third'}])
+
+        response = self.client.get('/tasks/?ids=1,abc')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_task_list_gzip(self):
+        for _ in range(20):
+            self.insert_one_task('Task title', 'Some description')
+
+        response = self.client.get('/tasks/', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+
+        response = self.client.get('/tasks/?limit=1', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertFalse(response.has_header('Content-Encoding'))
+
+    @override_settings(PAGINATION_ESTIMATE_THRESHOLD=2)
+    def test_task_list_estimated_count(self):
+        for _ in range(3):
+            self.insert_one_task('Task title', 'Some description')
+
+        response = self.client.get('/tasks/', {'limit': 1})
+        content = json.loads(response.content)
+        self.assertEqual(content['count'], 3)
+        self.assertFalse(content['count_is_exact'])
+
+        response = self.client.get('/tasks/', {'limit': 1, 'search': 'title'})
+        content = json.loads(response.content)
+        self.assertEqual(content['count'], 3)
+        self.assertTrue(content['count_is_exact'])
+
+    @override_settings(SYNC_WATERMARK_MARGIN=timedelta(0))
+    def test_sync_without_watermark(self):
+        self.insert_one_task('Task title', 'Some description')
+        url = '/tasks/sync/'
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        content = json.loads(response.content)
+        self.assertEqual([task['id'] for task in content['tasks']], [1])
+        self.assertEqual(content['deleted'], {'tasks': [], 'comments': [], 'time_logs': []})
+        self.assertIn('watermark', content)
+        self.assertFalse(content['has_more'])
+
+    @override_settings(SYNC_WATERMARK_MARGIN=timedelta(0))
+    def test_sync_since_watermark(self):
+        self.insert_one_task('Unchanged', 'Some description')
+        self.insert_one_task('Changed', 'Some description')
+        task = Task.objects.get(id=2)
+        Comment.objects.create(text='Some comment text', task=task, author=self.user)
+
+        watermark = json.loads(self.client.get('/tasks/sync/').content)['watermark']
+
+        task.status = 'IP'
+        task.save()
+        self.client.delete('/tasks/1/')
+
+        response = self.client.get('/tasks/sync/', {'since': watermark})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        content = json.loads(response.content)
+        self.assertEqual([task['id'] for task in content['tasks']], [2])
+        self.assertEqual(content['comments'], [])
+        self.assertEqual(content['deleted']['tasks'], [1])
+
+    @override_settings(SYNC_WATERMARK_MARGIN=timedelta(0), SYNC_PAGE_SIZE=2)
+    def test_sync_pages(self):
+        for index in range(5):
+            self.insert_one_task(f'Task {index}', 'Some description')
+        # Rows changed in the same instant are paged by id
+        Task.objects.update(updated_at=datetime.now(timezone.utc) - timedelta(minutes=1))
+
+        pages, since = [], {}
+        while True:
+            content = json.loads(self.client.get('/tasks/sync/', since).content)
+            pages.append([task['id'] for task in content['tasks']])
+            since = {'since': content['watermark']}
+            if not content['has_more']:
+                break
+
+        self.assertEqual(pages, [[1, 2], [3, 4], [5]])
+        content = json.loads(self.client.get('/tasks/sync/', since).content)
+        self.assertEqual(content['tasks'], [])
+        self.assertFalse(content['has_more'])
+
+    def test_sync_holds_back_recent_changes(self):
+        self.insert_one_task('Task title', 'Some description')
+
+        content = json.loads(self.client.get('/tasks/sync/').content)
+        self.assertEqual(content['tasks'], [])
+
+        # Served once it is older than the margin, as it may have committed late
+        with override_settings(SYNC_WATERMARK_MARGIN=timedelta(0)):
+            content = json.loads(self.client.get('/tasks/sync/', {'since': content['watermark']}).content)
+        self.assertEqual([task['id'] for task in content['tasks']], [1])
+
+    def test_sync_invalid_watermark(self):
+        response = self.client.get('/tasks/sync/', {'since': 'yesterday'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.client.get('/tasks/sync/', {'since': '2021-13-45T00:00:00'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        for position in (['2021-01-01T00:00:00Z', {'a': 1}], ['2021-13-45T00:00:00Z', 1], [1, 1], ['2021-01-01T00:00:00Z']):
+            since = base64.urlsafe_b64encode(json.dumps({'tasks': position}).encode()).decode()
+            response = self.client.get('/tasks/sync/', {'since': since})
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, position)
+
+    @override_settings(SYNC_WATERMARK_MARGIN=timedelta(0))
+    def test_sync_own_time_logs(self):
+        self.insert_one_task('Task title', 'Some description')
+        time_log = TaskDuration.objects.create(owner=self.user, task_id=1, duration=60)
+        TaskDuration.objects.create(owner=self.user2, task_id=1, duration=60)
+        TaskDuration.objects.create(owner=self.user2, task_id=1, duration=60).delete()
+
+        content = json.loads(self.client.get('/tasks/sync/').content)
+        self.assertEqual([time_log['id'] for time_log in content['time_logs']], [time_log.pk])
+        self.assertEqual(content['deleted']['time_logs'], [])
+
+    def test_stats(self):
+        self.client.post('/tasks/', {'title': 'Task title', 'description': 'Task description'})
+        self.client.post('/tasks/', {'title': 'Task title', 'description': 'Task description'})
+        self.client.post('/tasks/', {'title': 'Task title', 'description': 'Task description'})
+        self.client.patch('/tasks/1/complete/')
+        self.client.patch('/tasks/2/owner/2/')
+        self.client.delete('/tasks/3/')
+
+        response = self.client.get('/tasks/stats/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(response.content), {'OP': 0, 'IP': 0, 'PA': 0, 'CO': 1})
+        self.assertEqual(TaskStatusCounter.objects.get(owner=self.user2).count, 1)
+
+    def test_stats_with_stale_copies(self):
+        self.insert_one_task('Task title', 'Some description')
+        first_copy, second_copy = Task.objects.get(), Task.objects.get()
+        for copy in (first_copy, second_copy):
+            copy.status = 'CO'
+            copy.save()
+
+        counters = dict(TaskStatusCounter.objects.filter(owner=self.user).values_list('status', 'count'))
+        self.assertEqual(counters, {'OP': 0, 'CO': 1})
+
+    def test_reconcile_task_counters(self):
+        self.insert_one_task('Task title', 'Some description')
+        Task.objects.bulk_create([Task(owner=self.user, title='Task title', description='Some description')])
+        TaskStatusCounter.objects.create(owner=self.user2, status='CO', count=3)
+
+        call_command('reconciletaskcounters', stdout=io.StringIO())
+
+        self.assertEqual(TaskStatusCounter.objects.get(owner=self.user, status='OP').count, 2)
+        self.assertEqual(TaskStatusCounter.objects.get(owner=self.user2, status='CO').count, 0)
+
+    @override_settings(TASK_THROTTLE={'RATE': 0.01, 'CAPACITY': 2, 'COSTS': {'search': 1}})
+    def test_search_throttled(self):
+        url = '/tasks/?search=ta'
+        for _ in range(2):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertLessEqual(int(response['Retry-After']), 100)
+
+        response = self.client.get('/tasks/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(get_throttle_counters(), {'search': {'allowed': 2, 'throttled': 1}})
+
 
 class TaskDurationViewSetTest(TaskViewSetTest):
 
@@ -246,7 +658,283 @@ class TaskDurationViewSetTest(TaskViewSetTest):
         response = self.client.get(url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
+    def test_reap_stale_timers(self):
+        self.insert_one_task('Task title', 'task description')
+        task = Task.objects.get()
+        stale_timer = TaskDuration.objects.create(owner=self.user, task=task, duration=60)
+        fresh_timer = TaskDuration.objects.create(owner=self.user2, task=task)
+        TaskDuration.objects.filter(pk=stale_timer.pk).update(
+            start_working_datetime=datetime.now(timezone.utc) - timedelta(hours=3)
+        )
 
+        call_command('reapstaletimers', idle_minutes=60, batch_size=1, stdout=io.StringIO())
 
+        stale_timer.refresh_from_db()
+        self.assertFalse(stale_timer.timer_on)
+        self.assertTrue(stale_timer.auto_stopped)
+        # Nothing shows the timer was used after it started
+        self.assertEqual(stale_timer.duration, 60)
+        self.assertEqual(stale_timer.stop_working_datetime, stale_timer.start_working_datetime)
 
+        fresh_timer.refresh_from_db()
+        self.assertTrue(fresh_timer.timer_on)
 
+    def test_timer_heartbeat(self):
+        self.insert_one_task('Task title', 'task description')
+        timer = TaskDuration.objects.create(owner=self.user, task_id=1)
+        other_timer = TaskDuration.objects.create(owner=self.user2, task_id=1)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/tasks/1/timer/heartbeat/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len([query for query in queries if 'tasks_' in query['sql']]), 0)
+
+        call_command('flushtimerheartbeats', batch_size=1, stdout=io.StringIO())
+        timer.refresh_from_db()
+        other_timer.refresh_from_db()
+        self.assertIsNotNone(timer.last_heartbeat_at)
+        self.assertIsNone(other_timer.last_heartbeat_at)
+
+        response = self.client.post('/tasks/abc/timer/heartbeat/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_heartbeat_of_reaped_timer(self):
+        self.insert_one_task('Task title', 'task description')
+        TaskDuration.objects.create(
+            owner=self.user, task_id=1, start_working_datetime=datetime.now(timezone.utc) - timedelta(hours=3)
+        )
+        call_command('reapstaletimers', idle_minutes=60, stdout=io.StringIO())
+
+        response = self.client.post('/tasks/1/timer/heartbeat/')
+        self.assertEqual(response.status_code, status.HTTP_410_GONE)
+
+        self.client.post('/tasks/1/timer/start/')
+        response = self.client.post('/tasks/1/timer/heartbeat/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_reap_timer_after_last_heartbeat(self):
+        self.insert_one_task('Task title', 'task description')
+        now = datetime.now(timezone.utc)
+        timer = TaskDuration.objects.create(owner=self.user, task_id=1)
+        alive_timer = TaskDuration.objects.create(owner=self.user2, task_id=1)
+        TaskDuration.objects.update(start_working_datetime=now - timedelta(hours=3))
+        TaskDuration.objects.filter(pk=timer.pk).update(last_heartbeat_at=now - timedelta(hours=2))
+        TaskDuration.objects.filter(pk=alive_timer.pk).update(last_heartbeat_at=now - timedelta(minutes=1))
+
+        call_command('reapstaletimers', idle_minutes=60, stdout=io.StringIO())
+
+        timer.refresh_from_db()
+        self.assertFalse(timer.timer_on)
+        self.assertEqual(timer.stop_working_datetime, timer.last_heartbeat_at)
+        self.assertEqual(timer.duration, 3600)
+        alive_timer.refresh_from_db()
+        self.assertTrue(alive_timer.timer_on)
+
+    def test_import_time_logs(self):
+        self.insert_one_task('Task title', 'task description')
+        upload = SimpleUploadedFile('time_logs.csv', (
+            b'task,start_working_datetime,duration\n'
+            b'1,2021-11-01T10:00:00Z,30\n'
+            b'2,2021-11-01T10:00:00Z,30\n'
+            b'1,2021-11-02T10:00:00Z,-5\n'
+        ))
+        response = self.client.post('/tasks/timer/import/', {'file': upload})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(response.content), {
+            'imported': 1,
+            'failed': 2,
+            'errors': [
+                {'row': 2, 'errors': {'task': ['Task does not exist.']}},
+                {'row': 3, 'errors': {'duration': ['Ensure this value is greater than or equal to 0.']}},
+            ]
+        })
+        time_log = TaskDuration.objects.get()
+        self.assertEqual(time_log.duration, 1800)
+        self.assertEqual(time_log.start_working_datetime, datetime(2021, 11, 1, 10, tzinfo=timezone.utc))
+
+    def test_import_time_logs_errors(self):
+        self.insert_one_task('Task title', 'task description')
+        records = [
+            {'task': 1, 'start_working_datetime': '2021-11-01T10:00:00Z', 'duration': 2 ** 31},
+            {'task': 1, 'start_working_datetime': '2021-11-01T10:00:00Z', 'duration': 30},
+            {'task': 1, 'start_working_datetime': '2021-11-02T10:00:00Z', 'duration': 30},
+        ]
+        bulk_create = QuerySet.bulk_create
+
+        def reject_second_chunk(queryset, objs, *args, **kwargs):
+            if objs[0].start_working_datetime.day == 2:
+                raise DataError('integer out of range')
+            return bulk_create(queryset, objs, *args, **kwargs)
+
+        with mock.patch.object(QuerySet, 'bulk_create', reject_second_chunk):
+            report = import_time_logs(records, self.user, chunk_size=2)
+
+        self.assertEqual(report, {
+            'imported': 1,
+            'failed': 2,
+            'errors': [
+                {'row': 1, 'errors': {'duration': ['Ensure this value is less than or equal to 35791394.']}},
+                {'row': 3, 'errors': {'non_field_errors': ['The database rejected this chunk of rows.']}},
+            ]
+        })
+        self.assertEqual(TaskDuration.objects.count(), 1)
+
+    def test_import_time_logs_command(self):
+        self.insert_one_task('Task title', 'task description')
+        with tempfile.NamedTemporaryFile('w', suffix='.ndjson') as time_logs:
+            for day in range(1, 6):
+                time_logs.write(json.dumps({'task': 1, 'start_working_datetime': f'2021-11-0{day}T10:00:00Z', 'duration': 10}))
+                time_logs.write('\n')
+            time_logs.write('not json\n')
+            time_logs.flush()
+
+            stdout, stderr = io.StringIO(), io.StringIO()
+            call_command('importtimelogs', time_logs.name, owner=self.user.email, batch_size=2, stdout=stdout, stderr=stderr)
+
+        self.assertIn('Imported 5 time logs, 1 rows failed', stdout.getvalue())
+        self.assertIn('Row 6', stderr.getvalue())
+        self.assertEqual(TaskDuration.objects.filter(owner=self.user, timer_on=False).count(), 5)
+
+
+class TaskAdminTest(TestCase):
+
+    def setUp(self) -> None:
+        self.user = CustomUser.objects.create_superuser(email='admin@gmail.com', password='1234')
+        self.client.force_login(self.user)
+        self.task = Task.objects.create(owner=self.user, title='Task title', description='Some description')
+
+    def get_changelist_queries(self, url: str) -> int:
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        # Only the paginator counts the filtered rows, the full result count is never run
+        count_queries = [query['sql'] for query in context.captured_queries if 'COUNT(' in query['sql']]
+        self.assertEqual(len(count_queries), 1, count_queries)
+        return len(context.captured_queries)
+
+    def test_time_duration_changelist_queries(self):
+        url = '/admin/tasks/taskduration/'
+        TaskDuration.objects.create(owner=self.user, task=self.task)
+        queries = self.get_changelist_queries(url)
+
+        TaskDuration.objects.bulk_create([TaskDuration(owner=self.user, task=self.task) for _ in range(10)])
+        self.assertEqual(self.get_changelist_queries(url), queries)
+
+    def test_changelists(self):
+        urls = ('/admin/tasks/task/', '/admin/tasks/comment/', '/admin/tasks/task/?status__exact=OP')
+        Comment.objects.create(text='Some comment text', task=self.task, author=self.user)
+        queries = {url: self.get_changelist_queries(url) for url in urls}
+
+        # Owners and authors of new rows are joined, not fetched one by one
+        for index in range(10):
+            owner = CustomUser.objects.create(email=f'owner{index}@gmail.com', password='1234')
+            task = Task.objects.create(owner=owner, title='Task title', description='Some description')
+            Comment.objects.create(text='Some comment text', task=task, author=owner)
+        for url in urls:
+            self.assertEqual(self.get_changelist_queries(url), queries[url], url)
+
+
+@skipUnless(len(settings.TASK_SHARDS) > 1, 'Set TASK_SHARDS to at least two databases to test sharding')
+class TaskShardingTest(APITestCase):
+    databases = '__all__'
+
+    def setUp(self) -> None:
+        self.user = CustomUser.objects.create(email='aaa.asdas@gmail.com', password='1234')
+        self.user2 = CustomUser.objects.create(email='aaa.asdas@gmail.cov', password='1234')
+        self.client.force_authenticate(self.user)
+        cache.clear()
+
+    def create_task(self, title: str) -> int:
+        response = self.client.post('/tasks/', {'title': title, 'description': 'Task description'})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return json.loads(response.content)['id']
+
+    def test_task_on_owner_shard(self):
+        task_id = self.create_task('Task title')
+        shard = shard_for_owner(self.user.pk)
+        self.assertTrue(Task.objects.using(shard).filter(pk=task_id).exists())
+
+        response = self.client.post(f'/tasks/{task_id}/comments/', {'text': 'some comment for task here'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(Comment.objects.using(shard).count(), 1)
+
+        response = self.client.get(f'/tasks/{task_id}/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(response.content)['owner'], self.user.pk)
+
+    def test_list_across_shards(self):
+        first_task_id = self.create_task('First task')
+        self.client.force_authenticate(self.user2)
+        second_task_id = self.create_task('Second task')
+        self.assertNotEqual(shard_for_owner(self.user.pk), shard_for_owner(self.user2.pk))
+
+        response = self.client.get('/tasks/')
+        content = json.loads(response.content)
+        self.assertEqual(content['count'], 2)
+        self.assertEqual([task['id'] for task in content['results']], [first_task_id, second_task_id])
+
+        response = self.client.get('/tasks/', {'limit': 1, 'offset': 1})
+        self.assertEqual([task['id'] for task in json.loads(response.content)['results']], [second_task_id])
+
+    def test_mine_before_rebalance(self):
+        task_id = self.create_task('Task title')
+        self.client.patch(f'/tasks/{task_id}/owner/{self.user2.pk}/')
+        self.assertNotEqual(shard_for_owner(self.user.pk), shard_for_owner(self.user2.pk))
+
+        # The task stays on the previous owner's shard until rebalancetasks moves it
+        self.client.force_authenticate(self.user2)
+        self.assertEqual(json.loads(self.client.get('/tasks/mine/').content), [{'id': task_id, 'title': 'Task title'}])
+
+    def test_rebalance_after_owner_change(self):
+        task_id = self.create_task('Task title')
+        self.client.post(f'/tasks/{task_id}/comments/', {'text': 'some comment for task here'})
+        self.client.patch(f'/tasks/{task_id}/owner/{self.user2.pk}/')
+
+        call_command('rebalancetasks', stdout=io.StringIO())
+
+        shard = shard_for_owner(self.user2.pk)
+        self.assertTrue(Task.objects.using(shard).filter(pk=task_id, owner=self.user2).exists())
+        self.assertEqual(Comment.objects.using(shard).filter(task_id=task_id).count(), 1)
+        self.assertEqual(self.client.get(f'/tasks/{task_id}/').status_code, status.HTTP_200_OK)
+
+        self.client.force_authenticate(self.user2)
+        self.assertEqual(json.loads(self.client.get('/tasks/stats/').content)['OP'], 1)
+        self.assertEqual(json.loads(self.client.get('/tasks/mine/').content), [{'id': task_id, 'title': 'Task title'}])
+
+    def test_rebalance_backfill(self):
+        task_id = self.create_task('Task title')
+        TaskShard.objects.all().delete()
+
+        call_command('rebalancetasks', stdout=io.StringIO())
+        self.assertFalse(TaskShard.objects.exists())
+
+        call_command('rebalancetasks', backfill=True, stdout=io.StringIO())
+        self.assertEqual(TaskShard.objects.get().task_id, task_id)
+
+    def test_unregister_removed_tasks(self):
+        deleted_task_id = self.create_task('Deleted task')
+        self.client.delete(f'/tasks/{deleted_task_id}/')
+        self.client.force_authenticate(self.user2)
+        self.create_task('Task of a removed owner')
+
+        call_command('purgedeletedtasks', stdout=io.StringIO())
+        self.user2.delete()
+
+        self.assertFalse(TaskShard.objects.exists())
+
+    @override_settings(SHARD_ID_BLOCK_SIZE=10)
+    def test_shard_ids_reserved_in_blocks(self):
+        block = IdBlock()
+        with self.captureOnCommitCallbacks(execute=True):
+            first_ids = block.take(2)
+
+        with CaptureQueriesContext(connections[DEFAULT_DB_ALIAS]) as queries:
+            self.assertEqual(block.take(8), list(range(first_ids[-1] + 1, first_ids[-1] + 9)))
+        self.assertEqual(len(queries), 0)
+
+        # A reservation that never commits is not reused
+        with self.captureOnCommitCallbacks(execute=False):
+            last_ids = block.take(1)
+        self.assertGreater(last_ids[0], first_ids[-1] + 8)
+        self.assertNotEqual(block.take(1), [last_ids[0] + 1])
@@ -0,0 +1,149 @@
+import threading
+import time
+from typing import Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework.throttling import BaseThrottle
+
+# Refills the bucket for the time elapsed since the last call and takes `cost`
+# tokens from it when enough are available, all in one round trip to Redis.
+TOKEN_BUCKET_SCRIPT = """
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'timestamp')
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local cost = tonumber(ARGV[4])
+
+local tokens = tonumber(bucket[1]) or capacity
+local timestamp = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - timestamp) * rate)
+
+local allowed = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+end
+
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'timestamp', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+redis.call('HINCRBY', KEYS[2], allowed == 1 and 'allowed' or 'throttled', 1)
+return {allowed, tostring(tokens)}
+"""
+
+COUNTERS_KEY = 'throttle:counters:{action}'
+
+_local_lock = threading.Lock()
+
+
+def uses_redis_cache() -> bool:
+    return settings.CACHES['default']['BACKEND'].startswith('django_redis')
+
+
+def get_throttle_counters() -> dict:
+    """
+    Return the number of allowed and throttled requests for every throttled action.
+    """
+    actions = settings.TASK_THROTTLE['COSTS']
+
+    if uses_redis_cache():
+        from django_redis import get_redis_connection
+
+        connection = get_redis_connection('default')
+        pipeline = connection.pipeline()
+        for action in actions:
+            pipeline.hgetall(cache.make_key(COUNTERS_KEY.format(action=action)))
+        counters = {
+            action: {key.decode(): int(value) for key, value in values.items()}
+            for action, values in zip(actions, pipeline.execute())
+        }
+    else:
+        counters = {action: cache.get(COUNTERS_KEY.format(action=action), {}) for action in actions}
+
+    return {
+        action: {'allowed': values.get('allowed', 0), 'throttled': values.get('throttled', 0)}
+        for action, values in counters.items()
+    }
+
+
+class TokenBucketThrottle(BaseThrottle):
+    """
+    Per user and per action token bucket.
+
+    Each action listed in `TASK_THROTTLE['COSTS']` takes its cost from a bucket
+    holding at most `CAPACITY` tokens and refilled with `RATE` tokens per second.
+    Actions without a cost are never throttled.
+    """
+
+    def __init__(self):
+        self.tokens = None
+        self.cost = None
+
+    def get_action(self, request, view) -> str:
+        if view.action == 'list' and request.query_params.get('search'):
+            return 'search'
+        return view.action
+
+    def get_cache_key(self, request, action: str) -> str:
+        if request.user and request.user.is_authenticated:
+            ident = request.user.pk
+        else:
+            ident = self.get_ident(request)
+        return f'throttle:bucket:{action}:{ident}'
+
+    def allow_request(self, request, view):
+        action = self.get_action(request, view)
+        self.cost = settings.TASK_THROTTLE['COSTS'].get(action)
+        if self.cost is None:
+            return True
+
+        key = self.get_cache_key(request, action)
+        if uses_redis_cache():
+            allowed, self.tokens = self.consume_redis(key, action)
+        else:
+            allowed, self.tokens = self.consume_local(key, action)
+        return allowed
+
+    def consume_redis(self, key: str, action: str) -> Tuple[bool, float]:
+        from django_redis import get_redis_connection
+
+        connection = get_redis_connection('default')
+        allowed, tokens = connection.eval(
+            TOKEN_BUCKET_SCRIPT, 2,
+            cache.make_key(key), cache.make_key(COUNTERS_KEY.format(action=action)),
+            self.rate, self.capacity, time.time(), self.cost,
+        )
+        return bool(allowed), float(tokens)
+
+    def consume_local(self, key: str, action: str) -> Tuple[bool, float]:
+        counters_key = COUNTERS_KEY.format(action=action)
+
+        with _local_lock:
+            now = time.time()
+            tokens, timestamp = cache.get(key, (self.capacity, now))
+            tokens = min(self.capacity, tokens + max(0.0, now - timestamp) * self.rate)
+
+            allowed = tokens >= self.cost
+            if allowed:
+                tokens -= self.cost
+            cache.set(key, (tokens, now), timeout=int(self.capacity / self.rate) + 1)
+
+            counters = cache.get(counters_key, {})
+            outcome = 'allowed' if allowed else 'throttled'
+            counters[outcome] = counters.get(outcome, 0) + 1
+            cache.set(counters_key, counters, timeout=None)
+
+        return allowed, tokens
+
+    @property
+    def rate(self) -> float:
+        return settings.TASK_THROTTLE['RATE']
+
+    @property
+    def capacity(self) -> float:
+        return settings.TASK_THROTTLE['CAPACITY']
+
+    def wait(self) -> Optional[float]:
+        if self.cost > self.capacity:
+            return None
+        return (self.cost - self.tokens) / self.rate
@@ -1,23 +1,49 @@
+import codecs
+import time
 from datetime import datetime, timezone, timedelta
+from itertools import chain
 
-from rest_framework import viewsets, filters, mixins
+from rest_framework import viewsets, filters, mixins, status
 from rest_framework.decorators import action
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.parsers import MultiPartParser
 from rest_framework.response import Response
-from django.core.cache import cache
-from django.db.models import Sum
+from django.conf import settings
+from django.db.models import Count, F, Sum
 from django.shortcuts import get_object_or_404
+from django_filters.rest_framework import DjangoFilterBackend
 from drf_yasg.utils import swagger_auto_schema
 from drf_yasg.utils import no_body
+from drf_yasg import openapi
 
-from .models import Task, Comment, TaskDuration
+from .models import Task, Comment, TaskDuration, TaskStatusCounter
 from apps.users.models import CustomUser
-from .service import send_user_email, get_all_commentators
+from config.cache import get_or_compute
+from .service import (
+    send_user_email,
+    get_all_commentators,
+    decode_sync_cursor,
+    get_changes_since,
+    record_timer_heartbeat,
+    mark_timers_stopped,
+    clear_timer_stopped,
+    is_timer_stopped,
+)
 from .serializers import (
     ListTaskSerializer,
     RetrieveTaskSerializer,
     CommentSerializer,
-    AddTimeOnSpecificDateSerializer
+    AddTimeOnSpecificDateSerializer,
+    MoveTaskSerializer,
+    DueDateSerializer,
+    parse_query_list
 )
+from .filters import TaskFilter
+from .imports import get_import_format, import_time_logs, read_records
+from .metrics import REQUESTS, REQUEST_DURATION
+from .pagination import EstimatedCountPagination
+from .sharding import ScatterGatherQuerySet, gather, is_sharded, scatter
+from .throttling import TokenBucketThrottle
 
 
 class TaskViewSet(mixins.CreateModelMixin,
@@ -27,12 +53,74 @@ class TaskViewSet(mixins.CreateModelMixin,
                   viewsets.GenericViewSet):
     queryset = Task.objects.all()
     serializer_class = ListTaskSerializer
-    filter_backends = [filters.SearchFilter]
+    filter_backends = [DjangoFilterBackend, filters.SearchFilter]
+    filterset_class = TaskFilter
     search_fields = ('title',)
+    throttle_classes = [TokenBucketThrottle]
+    pagination_class = EstimatedCountPagination
+
+    def get_queryset(self):
+        if self.lookup_field in self.kwargs:
+            queryset = Task.objects.for_task(self.kwargs[self.lookup_field])
+        else:
+            queryset = Task.objects.all()
+
+        if getattr(self, 'swagger_fake_view', False):
+            return queryset
+        if self.action == 'list':
+            # The order ScatterGatherQuerySet merges shards in
+            queryset = self.filter_ids(queryset).order_by('pk')
+        if self.action in ('list', 'retrieve'):
+            queryset = self.narrow_queryset(queryset)
+        return queryset
+
+    def filter_ids(self, queryset):
+        ids = parse_query_list(self.request.query_params.get('ids'))
+        if not ids:
+            return queryset
+
+        limit = settings.TASK_MULTI_GET_LIMIT
+        if len(ids) > limit or not all(task_id.isdigit() for task_id in ids):
+            raise ValidationError({'ids': f'Must be at most {limit} comma separated task ids.'})
+        return queryset.filter(pk__in=ids)
+
+    def narrow_queryset(self, queryset):
+        """
+        Load only the columns and relations the serializer is going to render.
+        """
+        fields = {name: field for name, field in self.get_serializer().fields.items() if not field.write_only}
+        columns = {field.name for field in Task._meta.concrete_fields}
+        queryset = queryset.only(Task._meta.pk.name, *(field.source for field in fields.values() if field.source in columns))
+
+        if 'owner' in fields and 'owner' in parse_query_list(self.request.query_params.get('expand')):
+            queryset = queryset.select_related('owner')
+        prefetch = [relation for relation in ('comments', 'task_duration') if relation in fields]
+        return queryset.prefetch_related(*prefetch)
+
+    def filter_queryset(self, queryset):
+        filter_queryset = super().filter_queryset
+        if self.action == 'list' and is_sharded():
+            return ScatterGatherQuerySet([filter_queryset(shard_queryset) for shard_queryset in scatter(queryset)])
+        return filter_queryset(queryset)
+
+    def initial(self, request, *args, **kwargs):
+        self.request_started_at = time.perf_counter()
+        super().initial(request, *args, **kwargs)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        action = self.action or 'unknown'
+        REQUESTS.inc(action, response.status_code)
+        if hasattr(self, 'request_started_at'):
+            REQUEST_DURATION.observe(time.perf_counter() - self.request_started_at, action)
+        return response
 
     def perform_create(self, serializer):
         serializer.save(owner=self.request.user)
 
+    def perform_destroy(self, instance):
+        instance.mark_deleted()
+
     def get_serializer_class(self):
         if self.action == 'retrieve':
             return RetrieveTaskSerializer
@@ -40,14 +128,21 @@ class TaskViewSet(mixins.CreateModelMixin,
 
     @action(detail=False, methods=['get'], url_path='mine')
     def my_tasks(self, request):
-        tasks = Task.objects.filter(owner=request.user).values('id', 'title')
+        tasks = gather(Task.objects.filter(owner=request.user).values('id', 'title'))
         return Response(tasks)
 
     @action(detail=False, methods=['get'], url_path='completed')
     def completed_tasks(self, request):
-        tasks = Task.objects.filter(status='CO').values('id', 'title')
+        tasks = gather(Task.objects.filter(status='CO').values('id', 'title'))
         return Response(tasks)
 
+    @action(detail=False, methods=['get'], url_path='stats')
+    def stats(self, request):
+        counters = {status: 0 for status, _ in Task.TASK_STATUS_CHOICES}
+        for status, count in gather(TaskStatusCounter.objects.filter(owner=request.user).values_list('status', 'count')):
+            counters[status] += count
+        return Response(counters)
+
     @swagger_auto_schema(request_body=no_body)
     @action(detail=True, methods=['patch'], url_path=r'owner/(?P<owner_id>\d+)')
     def set_task_owner(self, request, pk=None, owner_id=None):
@@ -70,26 +165,104 @@ class TaskViewSet(mixins.CreateModelMixin,
 
         return Response({'detail': 'success'})
 
+    @swagger_auto_schema(request_body=MoveTaskSerializer)
+    @action(detail=True, methods=['patch'], url_path='move')
+    def move(self, request, pk=None):
+        task = self.get_object()
+        serializer = MoveTaskSerializer(data=request.data, context={'task': task})
+        serializer.is_valid(raise_exception=True)
+        task.parent = serializer.validated_data['parent']
+        task.save()
+        return Response({'detail': 'success'})
+
+    @swagger_auto_schema(request_body=DueDateSerializer)
+    @action(detail=True, methods=['patch'], url_path='due')
+    def set_due_date(self, request, pk=None):
+        task = self.get_object()
+        serializer = DueDateSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        task.due_at = serializer.validated_data['due_at']
+        task.due_reminder_sent_at = None
+        task.save()
+        return Response({'detail': 'success'})
+
+    @action(detail=True, methods=['get'], url_path='subtree')
+    def subtree(self, request, pk=None):
+        task = self.get_object()
+        tasks = Task.objects \
+            .using(task._state.db) \
+            .filter(ancestor_links__ancestor=task) \
+            .annotate(depth=F('ancestor_links__depth')) \
+            .order_by('depth', 'pk') \
+            .values('id', 'title', 'status', 'parent', 'depth')
+
+        max_depth = request.query_params.get('max_depth')
+        if max_depth is not None:
+            if not max_depth.isdigit():
+                raise ValidationError({'max_depth': 'Must be a non-negative integer.'})
+            tasks = tasks.filter(depth__lte=int(max_depth))
+
+        page = self.paginate_queryset(tasks)
+        return self.get_paginated_response(page)
+
+    @action(detail=True, methods=['get'], url_path='rollup')
+    def rollup(self, request, pk=None):
+        task = self.get_object()
+        statuses = {status: 0 for status, _ in Task.TASK_STATUS_CHOICES}
+        statuses.update(
+            Task.objects
+            .using(task._state.db)
+            .filter(ancestor_links__ancestor=task)
+            .values_list('status')
+            .annotate(count=Count('pk'))
+            .order_by()
+        )
+        total_duration = TaskDuration.objects \
+            .using(task._state.db) \
+            .filter(task__ancestor_links__ancestor=task) \
+            .aggregate(total_duration=Sum('duration'))['total_duration'] or 0
+
+        return Response({
+            'tasks': sum(statuses.values()),
+            'statuses': statuses,
+            'task_duration': total_duration // 60,
+        })
+
     @action(detail=False, methods=['get'], url_path='top-last-month')
     def get_top_tasks_last_month(self, request):
-        user = request.user.email
-        top_tasks = cache.get(user)
-        if top_tasks:
-            return Response(top_tasks)
+        top_tasks = get_or_compute('tasks:top-last-month', self.compute_top_tasks_last_month,
+                                   timeout=settings.TOP_TASKS_CACHE_TIMEOUT)
+        return Response(top_tasks)
 
+    @staticmethod
+    def compute_top_tasks_last_month() -> list:
         tasks = Task.objects \
             .filter(created_at__gt=datetime.now() - timedelta(days=30)) \
             .annotate(total_duration=Sum('task_duration__duration')) \
             .order_by('-total_duration').values()
 
-        top_20_tasks = tasks[:20]
-        cache.set(user, top_20_tasks, timeout=60)
-        return Response(top_20_tasks)
+        if is_sharded():
+            return sorted(
+                chain.from_iterable(shard_tasks[:20] for shard_tasks in scatter(tasks)),
+                key=lambda task: task['total_duration'] or 0, reverse=True
+            )[:20]
+        return list(tasks[:20])
+
+    @action(detail=False, methods=['get'], url_path='sync')
+    def sync(self, request):
+        since = request.query_params.get('since')
+        try:
+            positions = decode_sync_cursor(since) if since is not None else {}
+        except ValueError:
+            raise ValidationError({'since': 'Must be a watermark returned by a previous sync.'})
+
+        changes = get_changes_since(request.user, positions)
+        return Response(changes)
 
     @action(detail=True, url_path='comments')
     def comments(self, request, pk=None):
         task = self.get_object()
-        comments = Comment.objects.filter(task=task).values()
+        comments = Comment.objects.for_task(task).values()
         return Response(comments)
 
     @comments.mapping.post
@@ -105,23 +278,36 @@ class TaskViewSet(mixins.CreateModelMixin,
     def timer_start(self, request, pk):
         task = self.get_object()
 
-        task_duration, created = TaskDuration.objects.update_or_create(
+        task_duration, created = TaskDuration.objects.for_task(task).update_or_create(
             owner=request.user, task=task,
             defaults={
                 'timer_on': True,
-                'start_working_datetime': datetime.now(timezone.utc)
+                'start_working_datetime': datetime.now(timezone.utc),
+                'last_heartbeat_at': None,
             }
         )
+        clear_timer_stopped(request.user.pk, task.pk)
 
         if created:
             return Response({'detail': 'timer start'})
         return Response({'detail': 'timer start'})
 
+    @swagger_auto_schema(request_body=no_body)
+    @action(detail=True, methods=['post'], url_path='timer/heartbeat')
+    def timer_heartbeat(self, request, pk):
+        if not pk.isdigit():
+            raise NotFound()
+        # Only touches the cache, flushtimerheartbeats persists heartbeats of running timers
+        if is_timer_stopped(request.user.pk, int(pk)):
+            return Response({'detail': 'timer stopped'}, status=status.HTTP_410_GONE)
+        record_timer_heartbeat(request.user.pk, int(pk))
+        return Response({'detail': 'timer heartbeat'})
+
     @action(detail=True, methods=['post'], url_path='timer/stop')
     def timer_stop(self, request, pk):
         task = self.get_object()
         existing_task = get_object_or_404(
-            TaskDuration.objects.filter(task=task, owner=request.user, timer_on=True),
+            TaskDuration.objects.for_task(task).filter(owner=request.user, timer_on=True),
             pk=pk
         )
 
@@ -135,6 +321,8 @@ class TaskViewSet(mixins.CreateModelMixin,
         existing_task.timer_on = False
         existing_task.stop_working_datetime = datetime.now(timezone.utc)
         existing_task.save()
+        # Tells the client's other devices, which may still be sending heartbeats
+        mark_timers_stopped([(request.user.pk, task.pk)])
 
         return Response({'details': 'timer stop'})
 
@@ -146,10 +334,27 @@ class TaskViewSet(mixins.CreateModelMixin,
         serializer.save(owner=request.user)
         return Response(serializer.data)
 
+    @swagger_auto_schema(manual_parameters=[
+        openapi.Parameter('file', openapi.IN_FORM, type=openapi.TYPE_FILE, required=True,
+                          description='CSV or NDJSON with task, start_working_datetime and duration in minutes')
+    ])
+    @action(detail=False, methods=['post'], url_path='timer/import', parser_classes=[MultiPartParser])
+    def import_time_logs(self, request):
+        upload = request.FILES.get('file')
+        if upload is None:
+            raise ValidationError({'file': 'This field is required.'})
+        import_format = get_import_format(upload.name)
+        if import_format is None:
+            raise ValidationError({'file': 'Must be a .csv, .ndjson or .jsonl file.'})
+
+        lines = codecs.iterdecode(upload, 'utf-8', errors='replace')
+        report = import_time_logs(read_records(lines, import_format), request.user)
+        return Response(report)
+
     @action(detail=False, methods=['get'], url_path='timer/last-month')
     def get_last_month_time_logs(self, request):
-        newest_time_logs = TaskDuration.objects.filter(
+        newest_time_logs = gather(TaskDuration.objects.filter(
             owner=request.user,
             created_at__gt=datetime.now() - timedelta(days=30)
-        ).values()
+        ).values())
         return Response(newest_time_logs)
@@ -3,10 +3,12 @@ from rest_framework import generics, status
 from rest_framework.permissions import AllowAny
 from rest_framework.response import Response
 from rest_framework_simplejwt.tokens import RefreshToken
+from django.conf import settings
 from django.db import IntegrityError
 
 from .serializers import UserSerializer
 from .models import CustomUser
+from config.cache import get_or_compute
 
 
 class RegisterUserView(generics.GenericAPIView):
@@ -42,3 +44,12 @@ class RegisterUserView(generics.GenericAPIView):
 class ListUserView(generics.ListAPIView):
     queryset = CustomUser.objects.all()
     serializer_class = UserSerializer
+
+    def list(self, request, *args, **kwargs):
+        list_users = super().list
+        users = get_or_compute(
+            f'users:list:{request.query_params.urlencode()}',
+            lambda: list_users(request, *args, **kwargs).data,
+            timeout=settings.USER_LIST_CACHE_TIMEOUT
+        )
+        return Response(users)
@@ -0,0 +1,105 @@
+"""
+Stampede protected caching of expensive read paths.
+
+`get_or_compute` keeps the computed value for `timeout` seconds and serves it
+stale for `stale_timeout` more seconds while a single caller, holding a lock
+in the cache, recomputes it. Callers may also refresh a fresh value early,
+with a probability growing as it approaches expiry and with how long it took
+to compute (XFetch), so hot keys are usually refreshed before they go stale.
+"""
+import math
+import random
+import time
+import uuid
+from typing import Any, Callable, Optional
+
+from django.core.cache import cache
+
+from .metrics import Counter
+
+LOCK_KEY = 'lock:{key}'
+# How long a refresh may hold the lock before another caller takes over
+LOCK_TIMEOUT = 30
+# How often callers without a value poll for the one being computed
+WAIT_INTERVAL = 0.05
+# Larger values refresh earlier, 0 disables early refreshes
+EARLY_EXPIRY_BETA = 1.0
+
+LOOKUPS = Counter('cache_lookups_total', 'get_or_compute lookups by outcome', ('outcome',))
+
+
+def get_cache_stats() -> dict:
+    """
+    Return how many lookups in this process were fresh hits, stale hits, misses and refreshes.
+    """
+    return {outcome: LOOKUPS.get(outcome) for outcome in ('hit', 'stale', 'miss', 'refresh')}
+
+
+def acquire_lock(key: str) -> Optional[str]:
+    token = uuid.uuid4().hex
+    if cache.add(LOCK_KEY.format(key=key), token, timeout=LOCK_TIMEOUT):
+        return token
+    return None
+
+
+def release_lock(key: str, token: str):
+    lock_key = LOCK_KEY.format(key=key)
+    if cache.get(lock_key) == token:
+        cache.delete(lock_key)
+
+
+def compute_and_set(key: str, compute: Callable[[], Any], timeout: int, stale_timeout: int) -> Any:
+    started = time.monotonic()
+    value = compute()
+    entry = {
+        'value': value,
+        'expires_at': time.time() + timeout,
+        'compute_time': time.monotonic() - started,
+    }
+    cache.set(key, entry, timeout=timeout + stale_timeout)
+    return value
+
+
+def is_expired(entry: dict, now: float) -> bool:
+    early_by = -entry['compute_time'] * EARLY_EXPIRY_BETA * math.log(1.0 - random.random())
+    return now + early_by >= entry['expires_at']
+
+
+def get_or_compute(key: str, compute: Callable[[], Any], timeout: int, stale_timeout: Optional[int] = None) -> Any:
+    """
+    Return the cached value of `key`, computing it with `compute` at most once
+    at a time across all processes sharing the cache.
+    """
+    if stale_timeout is None:
+        stale_timeout = timeout
+
+    entry = cache.get(key)
+    if entry is not None and not is_expired(entry, time.time()):
+        LOOKUPS.inc('hit')
+        return entry['value']
+
+    token = acquire_lock(key)
+    if token is None and entry is not None:
+        # Someone else is refreshing it
+        LOOKUPS.inc('stale')
+        return entry['value']
+
+    if token is None:
+        # Someone else is computing it, wait for their value rather than computing it again
+        deadline = time.monotonic() + LOCK_TIMEOUT
+        while time.monotonic() < deadline:
+            time.sleep(WAIT_INTERVAL)
+            entry = cache.get(key)
+            if entry is not None:
+                LOOKUPS.inc('hit')
+                return entry['value']
+            token = acquire_lock(key)
+            if token is not None:
+                break
+
+    LOOKUPS.inc('refresh' if entry is not None else 'miss')
+    try:
+        return compute_and_set(key, compute, timeout, stale_timeout)
+    finally:
+        if token is not None:
+            release_lock(key, token)
@@ -0,0 +1,350 @@
+"""
+In-process metrics exposed in the Prometheus text format at /metrics.
+
+Counters and histograms are plain dictionaries updated under a lock, so
+recording a value costs a few microseconds. Gauges that are cheaper to read
+than to track, like the number of running timers, are computed when /metrics
+is scraped by collectors registered with `registry.register_collector`.
+
+When `METRICS_DIR` is set every worker process writes its counters and
+histograms to `<METRICS_DIR>/<pid>-<random id>.json` at most every
+`METRICS_FLUSH_INTERVAL` seconds and on exit, and /metrics sums the files of
+all processes. Files of processes that are no longer running are merged into
+`total.json`, so counters survive worker restarts. The directory must not be
+shared between hosts, as workers are told apart by their pid.
+
+/metrics is served to `METRICS_ALLOWED_IPS` and to requests bearing
+`METRICS_TOKEN`.
+"""
+import atexit
+import fcntl
+import hmac
+import json
+import os
+import threading
+import time
+import uuid
+from bisect import bisect_left
+from collections import namedtuple
+from contextlib import contextmanager
+from typing import Callable, Iterable, List, Optional, Tuple
+
+from django.conf import settings
+from django.db import connections
+from django.http import HttpResponse, HttpResponseForbidden
+
+MetricFamily = namedtuple('MetricFamily', ['name', 'type', 'documentation', 'samples'])
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+TOTAL_FILE_NAME = 'total.json'
+ROLLUP_LOCK_FILE_NAME = 'rollup.lock'
+
+
+def is_running(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def read_values(path: str) -> Optional[dict]:
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def write_values(path: str, values: dict):
+    with open(f'{path}.tmp', 'w') as file:
+        json.dump(values, file)
+    os.replace(f'{path}.tmp', path)
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = {}
+        self.collectors = []
+        self.last_flush = time.monotonic()
+        self.flush_lock = threading.Lock()
+        self.file_pid = None
+        self._file_name = None
+
+    def register(self, metric: 'Metric'):
+        self.metrics[metric.name] = metric
+
+    def register_collector(self, collector: Callable[[], Iterable[MetricFamily]]):
+        self.collectors.append(collector)
+        return collector
+
+    @property
+    def directory(self) -> Optional[str]:
+        return settings.METRICS_DIR
+
+    def maybe_flush(self):
+        if self.directory and time.monotonic() - self.last_flush >= settings.METRICS_FLUSH_INTERVAL:
+            self.flush()
+
+    @property
+    def file_name(self) -> str:
+        # A new id per process, a worker reusing the pid of a dead one must not overwrite its file
+        pid = os.getpid()
+        if self.file_pid != pid:
+            self.file_pid = pid
+            self._file_name = f'{pid}-{uuid.uuid4().hex}.json'
+        return self._file_name
+
+    def flush(self):
+        if not self.directory:
+            return
+
+        with self.flush_lock:
+            self.last_flush = time.monotonic()
+            values = {name: metric.dump() for name, metric in self.metrics.items()}
+            write_values(os.path.join(self.directory, self.file_name), values)
+
+    def merge(self, merged: dict, process_values: dict):
+        for name, rows in process_values.items():
+            metric = self.metrics.get(name)
+            if metric is None:
+                continue
+            values = merged.setdefault(name, {})
+            for labels, value in rows:
+                labels = tuple(labels)
+                values[labels] = metric.merge(values[labels], value) if labels in values else value
+
+    def roll_up(self):
+        """
+        Merge the files of processes that are no longer running into the total.
+        """
+        dead_file_names = [
+            file_name
+            for file_name in os.listdir(self.directory)
+            if file_name.endswith('.json') and file_name.split('-')[0].isdigit()
+            and not is_running(int(file_name.split('-')[0]))
+        ]
+        if not dead_file_names:
+            return
+
+        with open(os.path.join(self.directory, ROLLUP_LOCK_FILE_NAME), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            total_path = os.path.join(self.directory, TOTAL_FILE_NAME)
+            merged = {}
+            self.merge(merged, read_values(total_path) or {})
+            rolled_up = []
+            for file_name in dead_file_names:
+                process_values = read_values(os.path.join(self.directory, file_name))
+                if process_values is None:
+                    # Rolled up by another worker since it was listed
+                    continue
+                self.merge(merged, process_values)
+                rolled_up.append(file_name)
+            if not rolled_up:
+                return
+
+            write_values(total_path, {
+                name: [[list(labels), value] for labels, value in values.items()]
+                for name, values in merged.items()
+            })
+            for file_name in rolled_up:
+                os.remove(os.path.join(self.directory, file_name))
+
+    def load(self) -> dict:
+        """
+        Return the values of every metric, summed over all processes when `METRICS_DIR` is set.
+        """
+        if not self.directory:
+            return {name: metric.dump() for name, metric in self.metrics.items()}
+
+        self.flush()
+        self.roll_up()
+        merged = {}
+        for file_name in os.listdir(self.directory):
+            if not file_name.endswith('.json'):
+                continue
+            process_values = read_values(os.path.join(self.directory, file_name))
+            if process_values is not None:
+                self.merge(merged, process_values)
+
+        return {name: list(values.items()) for name, values in merged.items()}
+
+    def collect(self) -> List[MetricFamily]:
+        values = self.load()
+        families = [
+            metric.family(values.get(name, []))
+            for name, metric in sorted(self.metrics.items())
+        ]
+        for collector in self.collectors:
+            families.extend(collector())
+        return families
+
+    def render(self) -> str:
+        lines = []
+        for family in self.collect():
+            lines.append(f'# HELP {family.name} {escape_help(family.documentation)}')
+            lines.append(f'# TYPE {family.name} {family.type}')
+            for name, labels, value in family.samples:
+                lines.append(f'{name}{format_labels(labels)} {format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (), registry: Registry = registry):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+        self.registry = registry
+        registry.register(self)
+
+    def dump(self) -> list:
+        with self.lock:
+            return [[list(labels), value] for labels, value in self.values.items()]
+
+    def merge(self, value, other):
+        return value + other
+
+    def family(self, values: list) -> MetricFamily:
+        samples = [(self.name, dict(zip(self.labelnames, labels)), value) for labels, value in values]
+        return MetricFamily(self.name, self.type, self.documentation, samples)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, *labels, amount: float = 1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+        self.registry.maybe_flush()
+
+    def get(self, *labels) -> float:
+        return self.values.get(labels, 0)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, *args, buckets: Tuple[float, ...] = DEFAULT_BUCKETS, **kwargs):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(*args, **kwargs)
+
+    def observe(self, value: float, *labels):
+        bucket = bisect_left(self.buckets, value)
+        with self.lock:
+            observations = self.values.get(labels)
+            if observations is None:
+                # Observations per bucket, the last one being +Inf, and their sum
+                observations = self.values[labels] = {'counts': [0] * (len(self.buckets) + 1), 'sum': 0.0}
+            observations['counts'][bucket] += 1
+            observations['sum'] += value
+        self.registry.maybe_flush()
+
+    @contextmanager
+    def time(self, *labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def dump(self) -> list:
+        with self.lock:
+            return [
+                [list(labels), {'counts': list(observations['counts']), 'sum': observations['sum']}]
+                for labels, observations in self.values.items()
+            ]
+
+    def merge(self, value, other):
+        return {
+            'counts': [count + other_count for count, other_count in zip(value['counts'], other['counts'])],
+            'sum': value['sum'] + other['sum'],
+        }
+
+    def family(self, values: list) -> MetricFamily:
+        samples = []
+        for labels, observations in values:
+            labels = dict(zip(self.labelnames, labels))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), observations['counts']):
+                cumulative += count
+                samples.append((f'{self.name}_bucket', {**labels, 'le': format_value(bound)}, cumulative))
+            samples.append((f'{self.name}_sum', labels, observations['sum']))
+            samples.append((f'{self.name}_count', labels, cumulative))
+        return MetricFamily(self.name, self.type, self.documentation, samples)
+
+
+def escape_help(text: str) -> str:
+    return text.replace('\\', r'\\').replace('\n', r'\n')
+
+
+def format_labels(labels: dict) -> str:
+    if not labels:
+        return ''
+    escaped = (
+        '{}="{}"'.format(name, str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"'))
+        for name, value in labels.items()
+    )
+    return '{' + ','.join(escaped) + '}'
+
+
+def format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return str(value)
+
+
+@registry.register_collector
+def collect_database_connections() -> List[MetricFamily]:
+    """
+    Server side connections of every PostgreSQL database by state, across all workers.
+    """
+    connection_samples, max_connection_samples = [], []
+    for alias in connections:
+        connection = connections[alias]
+        if connection.vendor != 'postgresql':
+            continue
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT coalesce(state, \'unknown\'), count(*) FROM pg_stat_activity '
+                'WHERE datname = current_database() GROUP BY 1'
+            )
+            connection_samples.extend(
+                ('db_connections', {'database': alias, 'state': state}, count)
+                for state, count in cursor.fetchall()
+            )
+            cursor.execute('SHOW max_connections')
+            max_connection_samples.append(('db_connections_max', {'database': alias}, int(cursor.fetchone()[0])))
+
+    return [
+        MetricFamily('db_connections', 'gauge', 'Open database connections by state', connection_samples),
+        MetricFamily('db_connections_max', 'gauge', 'Maximum number of database connections', max_connection_samples),
+    ]
+
+
+def is_metrics_client(request) -> bool:
+    if request.META.get('REMOTE_ADDR') in settings.METRICS_ALLOWED_IPS:
+        return True
+    token = settings.METRICS_TOKEN
+    authorization = request.META.get('HTTP_AUTHORIZATION', '')
+    return bool(token) and hmac.compare_digest(authorization.encode(), f'Bearer {token}'.encode())
+
+
+def metrics_view(request):
+    if not is_metrics_client(request):
+        return HttpResponseForbidden()
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+if settings.METRICS_DIR:
+    atexit.register(registry.flush)
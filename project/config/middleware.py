@@ -0,0 +1,13 @@
+from django.conf import settings
+from django.middleware.gzip import GZipMiddleware
+
+
+class ThresholdGZipMiddleware(GZipMiddleware):
+    """
+    Gzip responses only once they are large enough for compression to pay off.
+    """
+
+    def process_response(self, request, response):
+        if not response.streaming and len(response.content) < settings.GZIP_MIN_LENGTH:
+            return response
+        return super().process_response(request, response)
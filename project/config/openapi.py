@@ -0,0 +1,8 @@
+from drf_yasg import openapi
+
+API_INFO = openapi.Info(
+   title="Tasks API",
+   default_version='v1',
+   description="Enjoy this API",
+   contact=openapi.Contact(email="contact@snippets.local"),
+)
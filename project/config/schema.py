@@ -0,0 +1,52 @@
+import hashlib
+from functools import lru_cache
+
+from django.conf import settings
+from django.http import HttpResponse
+from django.views.decorators.http import etag, require_safe
+
+
+@lru_cache(maxsize=None)
+def get_schema_document() -> tuple:
+    """
+    Return the OpenAPI document and its content type.
+
+    The document is read from `OPENAPI_SCHEMA_FILE` when it was prebuilt with
+    `manage.py generate_swagger`, otherwise it is generated once per process.
+    """
+    schema_file = settings.OPENAPI_SCHEMA_FILE
+    if schema_file.exists():
+        content_type = 'application/yaml' if schema_file.suffix in ('.yml', '.yaml') else 'application/json'
+        return schema_file.read_bytes(), content_type
+
+    from drf_yasg.codecs import OpenAPICodecJson
+    from drf_yasg.generators import OpenAPISchemaGenerator
+    from .openapi import API_INFO
+
+    schema = OpenAPISchemaGenerator(API_INFO).get_schema(request=None, public=True)
+    return OpenAPICodecJson(validators=[]).encode(schema), 'application/json'
+
+
+@lru_cache(maxsize=None)
+def get_schema_etag() -> str:
+    content, _ = get_schema_document()
+    return hashlib.sha1(content).hexdigest()
+
+
+@require_safe
+@etag(lambda request: get_schema_etag())
+def openapi_schema(request):
+    content, content_type = get_schema_document()
+    return HttpResponse(content, content_type=content_type)
+
+
+@require_safe
+def swagger_ui(request):
+    from drf_yasg import openapi
+    from drf_yasg.renderers import SwaggerUIRenderer
+    from .openapi import API_INFO
+
+    # The UI only needs the title and version, the document itself is fetched from `openapi_schema`
+    swagger = openapi.Swagger(info=API_INFO, _prefix='/', paths=openapi.Paths({}))
+    content = SwaggerUIRenderer().render(swagger, renderer_context={'request': request})
+    return HttpResponse(content, content_type='text/html; charset=utf-8')
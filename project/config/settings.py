@@ -22,6 +22,8 @@ SIMPLE_JWT = {
 
 # Swagger settings
 SWAGGER_SETTINGS = {
+    'DEFAULT_INFO': 'config.openapi.API_INFO',
+    'SPEC_URL': 'openapi-schema',
     'SECURITY_DEFINITIONS': {
         'Token': {
             'type': 'apiKey',
@@ -31,6 +33,10 @@ SWAGGER_SETTINGS = {
     }
 }
 
+# Prebuilt OpenAPI document served by config.schema,
+# written with `python manage.py generate_swagger openapi.json`
+OPENAPI_SCHEMA_FILE = BASE_DIR / 'openapi.json'
+
 # Application definition
 INSTALLED_APPS = [
     'django.contrib.admin',
@@ -41,11 +47,13 @@ INSTALLED_APPS = [
     'django.contrib.staticfiles',
     'apps.users',
     'apps.tasks',
+    'django_filters',
     'drf_yasg'
 ]
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'config.middleware.ThresholdGZipMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -94,6 +102,20 @@ DATABASES = {
     }
 }
 
+# Owner based sharding of task data, see apps.tasks.sharding.
+# Shards missing from DATABASES get a local SQLite database, e.g. TASK_SHARDS=default,shard1
+TASK_SHARDS = os.getenv('TASK_SHARDS', 'default').split(',')
+for shard in TASK_SHARDS:
+    DATABASES.setdefault(shard, {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': f'db_{shard}.sqlite3',
+    })
+
+DATABASE_ROUTERS = ['apps.tasks.sharding.TaskShardRouter']
+
+# Ids of sharded rows each process reserves at a time from the shared sequence
+SHARD_ID_BLOCK_SIZE = 100
+
 # Cache settings
 CACHES = {
     "default": {
@@ -124,6 +146,66 @@ REST_FRAMEWORK = {
     'PAGE_SIZE': 100
 }
 
+# Listings larger than this report an estimated count,
+# see apps.tasks.pagination.EstimatedCountPagination
+PAGINATION_ESTIMATE_THRESHOLD = 10000
+
+# Running timers idle for longer than this are stopped by the reapstaletimers command
+TIMER_IDLE_LIMIT = timedelta(hours=12)
+
+# Seconds a timer heartbeat is kept in the cache for the flushtimerheartbeats command
+TIMER_HEARTBEAT_TIMEOUT = 600
+
+# Time log imports validate and insert this many rows at a time and report
+# at most IMPORT_MAX_ERRORS invalid rows, see apps.tasks.imports
+IMPORT_CHUNK_SIZE = 1000
+IMPORT_MAX_ERRORS = 1000
+
+# Task owners are reminded this long before their task is due,
+# see the sendduereminders command
+TASK_DUE_REMINDER_LEAD = timedelta(hours=1)
+
+# Seconds cached read paths stay fresh, they are served stale as long again
+# while one worker recomputes them, see config.cache.get_or_compute
+TOP_TASKS_CACHE_TIMEOUT = 60
+USER_LIST_CACHE_TIMEOUT = 30
+
+# Worker processes share metrics through files in this directory, unset for
+# a single process, see config.metrics
+METRICS_DIR = os.getenv('METRICS_DIR')
+METRICS_FLUSH_INTERVAL = 5
+
+# /metrics is served to these addresses and to requests with an
+# "Authorization: Bearer <METRICS_TOKEN>" header
+METRICS_ALLOWED_IPS = os.getenv('METRICS_ALLOWED_IPS', '127.0.0.1,::1').split(',')
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+
+# /tasks/sync/ returns at most SYNC_PAGE_SIZE rows of each kind per call and
+# holds back rows changed more recently than SYNC_WATERMARK_MARGIN, which must
+# exceed the longest transaction, see apps.tasks.service.get_changes_since
+SYNC_PAGE_SIZE = 500
+SYNC_WATERMARK_MARGIN = timedelta(seconds=30)
+
+# Maximum number of tasks fetched at once with /tasks/?ids=
+TASK_MULTI_GET_LIMIT = 100
+
+# Responses shorter than this many bytes are sent uncompressed,
+# see config.middleware.ThresholdGZipMiddleware
+GZIP_MIN_LENGTH = 1024
+
+# Token bucket throttling of the expensive TaskViewSet actions,
+# see apps.tasks.throttling.TokenBucketThrottle
+TASK_THROTTLE = {
+    'RATE': 0.5,
+    'CAPACITY': 30,
+    'COSTS': {
+        'get_top_tasks_last_month': 10,
+        'get_last_month_time_logs': 5,
+        'search': 3,
+        'import_time_logs': 30,
+    }
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
@@ -0,0 +1,124 @@
+import json
+import os
+import subprocess
+import tempfile
+
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from rest_framework import status
+
+from config.cache import acquire_lock, get_cache_stats, get_or_compute, release_lock
+from config.metrics import Counter, Histogram, Registry
+
+
+class SchemaViewTest(TestCase):
+
+    def test_swagger_ui(self):
+        response = self.client.get('/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertContains(response, '/openapi.json')
+
+    def test_openapi_schema(self):
+        response = self.client.get('/openapi.json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('/tasks/', json.loads(response.content)['paths'])
+
+        response = self.client.get('/openapi.json', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+
+class GetOrComputeTest(TestCase):
+
+    def setUp(self) -> None:
+        cache.clear()
+        self.computed = []
+
+    def compute(self):
+        self.computed.append(len(self.computed) + 1)
+        return self.computed[-1]
+
+    def expire(self, key: str):
+        entry = cache.get(key)
+        entry['expires_at'] = 0
+        cache.set(key, entry)
+
+    def test_computes_once(self):
+        stats = get_cache_stats()
+        self.assertEqual(get_or_compute('key', self.compute, timeout=60), 1)
+        self.assertEqual(get_or_compute('key', self.compute, timeout=60), 1)
+        self.assertEqual(self.computed, [1])
+
+        new_stats = get_cache_stats()
+        self.assertEqual(new_stats['miss'] - stats['miss'], 1)
+        self.assertEqual(new_stats['hit'] - stats['hit'], 1)
+
+    def test_serves_stale_value_while_refreshing(self):
+        get_or_compute('key', self.compute, timeout=60)
+        self.expire('key')
+
+        token = acquire_lock('key')
+        self.assertEqual(get_or_compute('key', self.compute, timeout=60), 1)
+        release_lock('key', token)
+
+        self.assertEqual(get_or_compute('key', self.compute, timeout=60), 2)
+        self.assertEqual(get_or_compute('key', self.compute, timeout=60), 2)
+
+
+class MetricsTest(TestCase):
+
+    def setUp(self) -> None:
+        self.registry = Registry()
+        self.requests = Counter('requests_total', 'Requests', ('action',), registry=self.registry)
+        self.duration = Histogram('duration_seconds', 'Duration', buckets=(0.1, 1.0), registry=self.registry)
+
+    def test_render(self):
+        self.requests.inc('list')
+        self.requests.inc('list')
+        self.duration.observe(0.5)
+
+        self.assertEqual(self.registry.render(), '\n'.join([
+            '# HELP duration_seconds Duration',
+            '# TYPE duration_seconds histogram',
+            'duration_seconds_bucket{le="0.1"} 0',
+            'duration_seconds_bucket{le="1.0"} 1',
+            'duration_seconds_bucket{le="+Inf"} 1',
+            'duration_seconds_sum 0.5',
+            'duration_seconds_count 1',
+            '# HELP requests_total Requests',
+            '# TYPE requests_total counter',
+            'requests_total{action="list"} 2',
+        ]) + '\n')
+
+    def test_aggregates_processes(self):
+        dead_pid = self.dead_pid()
+        with tempfile.TemporaryDirectory() as directory, override_settings(METRICS_DIR=directory):
+            with open(os.path.join(directory, f'{dead_pid}-1.json'), 'w') as file:
+                json.dump({'requests_total': [[['list'], 3]]}, file)
+            self.requests.inc('list')
+
+            self.assertIn('requests_total{action="list"} 4', self.registry.render())
+            # The dead process is rolled up once
+            self.assertIn('requests_total{action="list"} 4', self.registry.render())
+            self.assertEqual(sorted(os.listdir(directory)), sorted([
+                self.registry.file_name, 'rollup.lock', 'total.json'
+            ]))
+            self.assertTrue(self.registry.file_name.startswith(f'{os.getpid()}-'))
+
+    def dead_pid(self) -> int:
+        process = subprocess.Popen(['true'])
+        process.wait()
+        return process.pid
+
+    def test_metrics_view(self):
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertContains(response, 'task_running_timers 0')
+        self.assertContains(response, '# TYPE cache_lookups_total counter')
+
+    @override_settings(METRICS_ALLOWED_IPS=[], METRICS_TOKEN='secret')
+    def test_metrics_view_requires_token(self):
+        self.assertEqual(self.client.get('/metrics').status_code, status.HTTP_403_FORBIDDEN)
+        response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer wrong')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)